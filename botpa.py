@@ -1,14 +1,24 @@
 import sqlite3
+import html
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import logging
 import os
 import re
 import asyncio
+import contextvars
+import signal
 import random
+import gzip
+import time
+import csv
+from collections import Counter
+import tempfile
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 
 # Настройка логирования
 logging.basicConfig(
@@ -21,6 +31,18 @@ logger = logging.getLogger(__name__)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, 'bot_interactions.db')
 TASKS_PATH = os.path.join(BASE_DIR, 'tasks.txt')
+ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+
+# Обслуживание базы данных
+RETENTION_DAYS = 180  # Сколько дней хранить взаимодействия в основной БД (None - хранить всегда)
+ARCHIVE_BATCH_SIZE = 1000  # Сколько строк переносить в архив за одну транзакцию
+MAINTENANCE_INTERVAL = 24 * 60 * 60  # Период запуска обслуживания в секундах
+WAL_CHECKPOINT_MODE = "TRUNCATE"  # PASSIVE, FULL, RESTART или TRUNCATE
+
+# Экспорт взаимодействий
+EXPORT_BATCH_SIZE = 500  # Сколько строк читать из БД за один fetchmany
+EXPORT_FIELDS = ["id", "user_id", "username", "user_message", "bot_response", "timestamp"]
+EXPORT_MAX_FILE_SIZE = 50 * 1024 * 1024  # Лимит Telegram на загрузку файла ботом
 
 async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
@@ -39,7 +61,7 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         num_interactions = 5
     
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(current_profile().db_path)
         cursor = conn.cursor()
         
         # Получение последних взаимодействий пользователя
@@ -76,13 +98,88 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if 'conn' in locals():
             conn.close()
 
+SEARCH_RESULTS_LIMIT = 10
+# Маркеры совпадений в сниппете, заменяются на HTML-теги после экранирования
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+def format_snippet(snippet):
+    """Экранирует сниппет для HTML и подсвечивает совпадения."""
+    snippet = html.escape(snippet or '')
+    return snippet.replace(SNIPPET_START, '<b>').replace(SNIPPET_END, '</b>')
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Полнотекстовый поиск по истории взаимодействий пользователя.
+    Использование: /search <запрос>
+    """
+    user_id = update.effective_user.id
+    query_text = ' '.join(context.args) if context.args else ''
+    match_query = build_search_query(query_text)
+
+    if not match_query:
+        await update.message.reply_text(
+            "🔎 Укажите, что искать. Например: /search прогулка"
+        )
+        return
+
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        cursor = conn.cursor()
+
+        # Поиск только по записям текущего пользователя, лучшие совпадения первыми
+        cursor.execute('''
+            SELECT
+                i.timestamp,
+                snippet(interactions_fts, 0, ?, ?, '…', 12),
+                snippet(interactions_fts, 1, ?, ?, '…', 12)
+            FROM interactions_fts
+            JOIN interactions i ON i.id = interactions_fts.rowid
+            WHERE interactions_fts MATCH ? AND i.user_id = ?
+            ORDER BY bm25(interactions_fts)
+            LIMIT ?
+        ''', (SNIPPET_START, SNIPPET_END, SNIPPET_START, SNIPPET_END,
+              match_query, user_id, SEARCH_RESULTS_LIMIT))
+
+        results = cursor.fetchall()
+
+        if not results:
+            await update.message.reply_text("🔎 Ничего не найдено.")
+            return
+
+        search_text = f"🔎 Результаты поиска по запросу «{html.escape(query_text)}»:\n\n"
+        for i, (timestamp, user_snippet, bot_snippet) in enumerate(results, 1):
+            search_text += f"<b>{i}.</b> 📅 {timestamp}\n"
+            search_text += f"👤 Вы: {format_snippet(user_snippet)}\n"
+            if bot_snippet:
+                search_text += f"🤖 Бот: {format_snippet(bot_snippet)}\n"
+            search_text += "\n"
+
+        await update.message.reply_text(search_text, parse_mode=ParseMode.HTML)
+
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка поиска: {e}")
+        await update.message.reply_text("Не удалось выполнить поиск.")
+
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
 def ensure_database():
     """Принудительная инициализация базы данных."""
     try:
         # Создаем соединение (если БД не существует, она будет создана)
-        conn = sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(current_profile().db_path)
         cursor = conn.cursor()
         
+        # WAL позволяет читать БД во время записи, incremental vacuum - возвращать место без полной блокировки
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA auto_vacuum")
+        if cursor.fetchone()[0] != 2:
+            cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            # Режим применяется к существующей БД только после полного VACUUM (однократно)
+            cursor.execute("VACUUM")
+        
         # Создаем таблицу, если она не существует
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS interactions (
@@ -99,6 +196,51 @@ def ensure_database():
         cursor.execute('''
             CREATE INDEX IF NOT EXISTS idx_user_id ON interactions(user_id)
         ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_timestamp ON interactions(timestamp)
+        ''')
+        
+        # Учет токенов и задержки для каждого запроса к API
+        ensure_columns(cursor, 'interactions', {
+            'model': 'TEXT',
+            'prompt_tokens': 'INTEGER',
+            'cached_tokens': 'INTEGER',
+            'completion_tokens': 'INTEGER',
+            'total_tokens': 'INTEGER',
+            'cost': 'REAL',
+            'latency_ms': 'INTEGER'
+        })
+        
+        # Дневные агрегаты расхода токенов по пользователям
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS usage_daily (
+                user_id INTEGER NOT NULL,
+                day DATE NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                cached_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                total_tokens INTEGER NOT NULL DEFAULT 0,
+                cost REAL NOT NULL DEFAULT 0,
+                latency_ms INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, day)
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_usage_daily_day ON usage_daily(day)
+        ''')
+        ensure_columns(cursor, 'usage_daily', {
+            'cached_tokens': 'INTEGER NOT NULL DEFAULT 0'
+        })
+        
+        # Типизированные события прогресса и агрегаты по пользователям
+        ensure_progress_tables(cursor)
+        
+        # Рассылки и пользователи, исключенные из них
+        ensure_broadcast_tables(cursor)
+        
+        # Полнотекстовый индекс для поиска по дневнику
+        ensure_search_index(cursor)
         
         conn.commit()
         logger.info("✅ База данных успешно инициализирована")
@@ -112,13 +254,210 @@ def ensure_database():
         if 'conn' in locals():
             conn.close()
 
-def log_interaction(user_id, username, user_message, bot_response):
-    """Логирование взаимодействия с принудительной инициализацией."""
-    # Принудительная инициализация перед логированием
-    ensure_database()
-    
+def ensure_columns(cursor, table, columns):
+    """Добавляет в таблицу недостающие столбцы (миграция существующей БД)."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cursor.fetchall()}
+    for name, column_type in columns.items():
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+def ensure_progress_tables(cursor):
+    """
+    Создание таблиц событий прогресса (events) и агрегатов по пользователям (user_progress).
+    При первом создании переносит выполненные задания и записи дневника из interactions.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'events'")
+    events_exist = cursor.fetchone() is not None
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            event_type TEXT NOT NULL,
+            payload TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_events_user ON events(user_id, created_at)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_progress (
+            user_id INTEGER PRIMARY KEY,
+            tasks_shown INTEGER NOT NULL DEFAULT 0,
+            tasks_completed INTEGER NOT NULL DEFAULT 0,
+            diary_entries INTEGER NOT NULL DEFAULT 0,
+            feedback_count INTEGER NOT NULL DEFAULT 0,
+            current_streak INTEGER NOT NULL DEFAULT 0,
+            longest_streak INTEGER NOT NULL DEFAULT 0,
+            last_active_day DATE
+        )
+    ''')
+
+    if events_exist:
+        return
+
+    # Перенос истории, раньше хранившейся в interactions в виде текста
+    # Записи дневника определяются тем же DIARY_MARKER_RE, что и новые сообщения
+    cursor.execute("SELECT user_id, timestamp, user_message FROM interactions ORDER BY id")
+    history = []
+    for user_id, timestamp, user_message in cursor.fetchall():
+        if user_message == 'Задание выполнено':
+            history.append((user_id, timestamp, 'task_completed'))
+        elif user_message and DIARY_MARKER_RE.search(user_message):
+            history.append((user_id, timestamp, 'diary_entry'))
+    for user_id, timestamp, event_type in history:
+        cursor.execute(
+            "INSERT INTO events (user_id, event_type, created_at) VALUES (?, ?, ?)",
+            (user_id, event_type, timestamp)
+        )
+        apply_progress_event(cursor, user_id, event_type, str(timestamp)[:10])
+    if history:
+        logger.info(f"📈 Перенесено событий прогресса из истории: {len(history)}")
+
+def ensure_broadcast_tables(cursor):
+    """
+    Создание таблиц получателей рассылок (users), рассылок (broadcasts) и пользователей,
+    заблокировавших бота (inactive_users). При первом создании users заполняется из interactions,
+    events и архива.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'")
+    users_exist = cursor.fetchone() is not None
+
+    # Все, кто когда-либо обращался к боту. Архивация interactions эту таблицу не затрагивает
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            first_seen DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    if not users_exist:
+        cursor.execute('''
+            INSERT OR IGNORE INTO users (user_id, first_seen)
+            SELECT user_id, MIN(first_seen) FROM (
+                SELECT user_id, MIN(timestamp) AS first_seen FROM interactions GROUP BY user_id
+                UNION ALL
+                SELECT user_id, MIN(created_at) FROM events GROUP BY user_id
+            )
+            GROUP BY user_id
+        ''')
+        # Пользователи, чьи взаимодействия уже перенесены в архив
+        for record in read_archived_interactions():
+            cursor.execute(
+                "INSERT OR IGNORE INTO users (user_id, first_seen) VALUES (?, ?)",
+                (record["user_id"], record["timestamp"])
+            )
+
+    # Пользователи, заблокировавшие бота, пропускаются при рассылках
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS inactive_users (
+            user_id INTEGER PRIMARY KEY,
+            reason TEXT,
+            inactive_since DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'draft',
+            total INTEGER NOT NULL DEFAULT 0,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME
+        )
+    ''')
+
+def register_user(cursor, user_id):
+    """Добавляет пользователя в число получателей рассылок (если его там еще нет)."""
+    cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+
+def ensure_search_index(cursor):
+    """
+    Создание полнотекстового индекса FTS5 по сообщениям и ответам.
+    Индекс синхронизируется с таблицей interactions триггерами.
+    """
+    try:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'interactions_fts'")
+        index_exists = cursor.fetchone() is not None
+
+        # unicode61 корректно разбивает кириллицу на слова и приводит к нижнему регистру,
+        # префиксные индексы ускоряют поиск по началу слова (разные окончания)
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS interactions_fts USING fts5(
+                user_message,
+                bot_response,
+                user_id UNINDEXED,
+                content='interactions',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3'
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS interactions_fts_insert AFTER INSERT ON interactions BEGIN
+                INSERT INTO interactions_fts(rowid, user_message, bot_response, user_id)
+                VALUES (new.id, new.user_message, new.bot_response, new.user_id);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS interactions_fts_delete AFTER DELETE ON interactions BEGIN
+                INSERT INTO interactions_fts(interactions_fts, rowid, user_message, bot_response, user_id)
+                VALUES ('delete', old.id, old.user_message, old.bot_response, old.user_id);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS interactions_fts_update AFTER UPDATE ON interactions BEGIN
+                INSERT INTO interactions_fts(interactions_fts, rowid, user_message, bot_response, user_id)
+                VALUES ('delete', old.id, old.user_message, old.bot_response, old.user_id);
+                INSERT INTO interactions_fts(rowid, user_message, bot_response, user_id)
+                VALUES (new.id, new.user_message, new.bot_response, new.user_id);
+            END
+        ''')
+
+        # Индексируем уже существующие записи только при первом создании индекса
+        if not index_exists:
+            cursor.execute("INSERT INTO interactions_fts(interactions_fts) VALUES ('rebuild')")
+            logger.info("🔎 Полнотекстовый индекс построен")
+        return True
+
+    except sqlite3.Error as e:
+        # Сборка SQLite без FTS5 - бот продолжает работать без поиска
+        logger.error(f"❌ Не удалось создать полнотекстовый индекс: {e}")
+        return False
+
+def build_search_query(text):
+    """
+    Преобразует запрос пользователя в безопасное выражение FTS5.
+    Каждое слово ищется по префиксу, все слова должны встретиться в записи.
+    """
+    words = re.findall(r'\w+', text.lower())
+    # Короткие слова дают слишком много совпадений
+    words = [word for word in words if len(word) > 1][:8]
+    if not words:
+        return None
+
+    terms = []
+    for word in words:
+        # Отрезаем окончание у длинных слов, чтобы находить другие формы слова
+        stem = word[:-2] if len(word) > 5 else word
+        terms.append(f'"{stem}"*')
+    return ' '.join(terms)
+
+def log_interaction(user_id, username, user_message, bot_response, usage=None):
+    """
+    Логирование взаимодействия (схема БД создается один раз при запуске, см. ensure_database).
+    usage - учет запроса к API (модель, токены, стоимость, задержка), обновляет дневные агрегаты.
+    """
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(current_profile().db_path)
         cursor = conn.cursor()
         
         # Усечение длинных сообщений
@@ -126,11 +465,37 @@ def log_interaction(user_id, username, user_message, bot_response):
         user_message = user_message[:max_length]
         bot_response = bot_response[:max_length] if bot_response else None
         
+        usage = usage or {}
         cursor.execute('''
             INSERT INTO interactions 
-            (user_id, username, user_message, bot_response) 
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, username, user_message, bot_response))
+            (user_id, username, user_message, bot_response,
+             model, prompt_tokens, cached_tokens, completion_tokens, total_tokens, cost, latency_ms) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, username, user_message, bot_response,
+              usage.get('model'), usage.get('prompt_tokens'), usage.get('cached_tokens'),
+              usage.get('completion_tokens'), usage.get('total_tokens'), usage.get('cost'),
+              usage.get('latency_ms')))
+        
+        # Пользователь снова пишет боту - возвращаем его в рассылки
+        register_user(cursor, user_id)
+        cursor.execute("DELETE FROM inactive_users WHERE user_id = ?", (user_id,))
+        
+        if usage:
+            cursor.execute('''
+                INSERT INTO usage_daily
+                (user_id, day, requests, prompt_tokens, cached_tokens, completion_tokens, total_tokens, cost, latency_ms)
+                VALUES (?, date('now'), 1, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, day) DO UPDATE SET
+                    requests = requests + 1,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    cached_tokens = cached_tokens + excluded.cached_tokens,
+                    completion_tokens = completion_tokens + excluded.completion_tokens,
+                    total_tokens = total_tokens + excluded.total_tokens,
+                    cost = cost + excluded.cost,
+                    latency_ms = latency_ms + excluded.latency_ms
+            ''', (user_id, usage.get('prompt_tokens') or 0, usage.get('cached_tokens') or 0,
+                  usage.get('completion_tokens') or 0,
+                  usage.get('total_tokens') or 0, usage.get('cost') or 0, usage.get('latency_ms') or 0))
         
         conn.commit()
         logger.info(f"📝 Логирование для пользователя {user_id}")
@@ -143,144 +508,896 @@ def log_interaction(user_id, username, user_message, bot_response):
     finally:
         if 'conn' in locals():
             conn.close()
-def read_tasks():
-    """Читает задания из файла tasks.txt"""
+
+def get_daily_tokens(user_id):
+    """Количество токенов, израсходованных пользователем за сегодня."""
     try:
-        if not os.path.exists(TASKS_PATH):
-            logger.error(f"❌ Файл с заданиями не найден: {TASKS_PATH}")
-            return ["Выполни простое задание: улыбнись!"]
-        
-        with open(TASKS_PATH, 'r', encoding='utf-8') as file:
-            tasks = file.read().splitlines()
-        
-        # Фильтруем пустые строки
-        tasks = [task for task in tasks if task.strip()]
-        
-        if not tasks:
-            logger.warning("⚠️ Файл с заданиями пуст")
-            return ["Выполни простое задание: улыбнись!"]
-        
-        return tasks
+        conn = sqlite3.connect(current_profile().db_path)
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT total_tokens FROM usage_daily WHERE user_id = ? AND day = date('now')",
+            (user_id,)
+        )
+        row = cursor.fetchone()
+        return row[0] if row else 0
     
-    except Exception as e:
-        logger.error(f"❌ Ошибка чтения файла заданий: {e}")
-        return ["Выполни простое задание: улыбнись!"]
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка чтения расхода токенов: {e}")
+        return 0
+    
+    finally:
+        if 'conn' in locals():
+            conn.close()
 
-async def task_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Отправляет пользователю случайное задание."""
-    tasks = read_tasks()
-    random_task = random.choice(tasks)
+# Запись дневника - сообщение, начинающееся со слов "Сегодня я"
+DIARY_MARKER_RE = re.compile(r'^\s*сегодня\s+я\b', re.IGNORECASE)
+
+# Типы событий прогресса
+EVENT_TYPES = ('task_shown', 'task_completed', 'diary_entry', 'feedback')
+# Счетчики user_progress для каждого типа события
+EVENT_COUNTERS = {
+    'task_shown': 'tasks_shown',
+    'task_completed': 'tasks_completed',
+    'diary_entry': 'diary_entries',
+    'feedback': 'feedback_count'
+}
+# События, которые засчитывают день в серию
+STREAK_EVENTS = ('task_completed', 'diary_entry')
+
+def apply_progress_event(cursor, user_id, event_type, day):
+    """Инкрементальное обновление счетчиков и серии активных дней пользователя."""
+    counter = EVENT_COUNTERS[event_type]
+    cursor.execute("INSERT OR IGNORE INTO user_progress (user_id) VALUES (?)", (user_id,))
+    cursor.execute(f"UPDATE user_progress SET {counter} = {counter} + 1 WHERE user_id = ?", (user_id,))
+
+    if event_type not in STREAK_EVENTS:
+        return
+
+    cursor.execute('''
+        SELECT current_streak, longest_streak, last_active_day,
+               julianday(?) - julianday(last_active_day)
+        FROM user_progress WHERE user_id = ?
+    ''', (day, user_id))
+    current_streak, longest_streak, last_active_day, days_since = cursor.fetchone()
+
+    if last_active_day is not None and days_since <= 0:
+        return  # День уже засчитан
+    current_streak = current_streak + 1 if days_since == 1 else 1
+    cursor.execute('''
+        UPDATE user_progress
+        SET current_streak = ?, longest_streak = ?, last_active_day = ?
+        WHERE user_id = ?
+    ''', (current_streak, max(longest_streak, current_streak), day, user_id))
+
+def record_event(user_id, event_type, payload=None):
+    """Запись события прогресса и обновление агрегатов в одной транзакции."""
+    if event_type not in EVENT_TYPES:
+        raise ValueError(f"Неизвестный тип события: {event_type}")
+
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT date('now')")
+        today = cursor.fetchone()[0]
+        
+        cursor.execute(
+            "INSERT INTO events (user_id, event_type, payload) VALUES (?, ?, ?)",
+            (user_id, event_type, json.dumps(payload, ensure_ascii=False) if payload is not None else None)
+        )
+        apply_progress_event(cursor, user_id, event_type, today)
+        register_user(cursor, user_id)
+        
+        conn.commit()
+        return True
     
-    keyboard = [
-        [InlineKeyboardButton("🔄 Другое задание", callback_data='new_task')],
-        [InlineKeyboardButton("✅ Задание выполнено", callback_data='task_completed')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка записи события {event_type}: {e}")
+        return False
     
-    await update.message.reply_text(
-        f"🎯 *Ваше задание*:\n\n{random_task}\n\n"
-        "Выполнение таких заданий поможет вам сократить виртуальное общение "
-        "и развить навыки реального общения.",
-        parse_mode=ParseMode.MARKDOWN,
-        reply_markup=reply_markup
-    )
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+def remember_user(user_id):
+    """Запоминает пользователя, который еще ничего не записал (например, только нажал /start)."""
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        register_user(conn.cursor(), user_id)
+        conn.commit()
     
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()  # Answer the callback query to remove the loading indicator
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка сохранения пользователя {user_id}: {e}")
     
-    data = query.data
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+def get_user_progress(user_id):
+    """Агрегаты прогресса пользователя (одна строка по первичному ключу) или None."""
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT *, julianday(date('now')) - julianday(last_active_day) AS days_since_active
+            FROM user_progress WHERE user_id = ?
+        ''', (user_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
     
-    if data == 'new_task':
-        # Send a new random task
-        tasks = read_tasks()
-        random_task = random.choice(tasks)
-        
-        keyboard = [
-            [InlineKeyboardButton("🔄 Другое задание", callback_data='new_task')],
-            [InlineKeyboardButton("✅ Задание выполнено", callback_data='task_completed')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            f"🎯 *Ваше задание*:\n\n{random_task}\n\n"
-            "Выполнение таких заданий поможет вам сократить виртуальное общение "
-            "и развить навыки реального общения.",
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=reply_markup
-        )
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка чтения прогресса: {e}")
+        return None
     
-    elif data == 'task_completed':
-        # Handle task completion
-        user_id = update.effective_user.id
-        username = update.effective_user.username or "Unknown"
-        
-        # Log completion
-        log_interaction(user_id, username, "Задание выполнено", "Пользователь отметил задание как выполненное")
-        
-        # Send a completion message with encouragement
-        await query.edit_message_text(
-            "🎉 *Отлично! Задание выполнено!*\n\n"
-            "Вы делаете важные шаги к сокращению виртуального общения в пользу живого!🎯"
-            "Продолжайте в том же духе!\n\n"
-            "Хотите получить новое задание? Используйте команду /task",
-            parse_mode=ParseMode.MARKDOWN
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+async def progress_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /progress - сводка выполненных заданий, записей дневника и серии дней."""
+    progress = get_user_progress(update.effective_user.id)
+    if not progress:
+        await update.message.reply_text(
+            "📈 У вас пока нет прогресса. Попробуйте /task или начните сообщение со слов 'Сегодня я...'"
         )
+        return
 
-# Немедленная инициализация при импорте модуля
-ensure_database()
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+    # Серия прерывается, если вчера и сегодня не было активности.
+    # Без выполненных заданий и записей дневника (только /task или отзывы) серии нет
+    days_since_active = progress["days_since_active"]
+    if days_since_active is not None and days_since_active <= 1:
+        current_streak = progress["current_streak"]
+    else:
+        current_streak = 0
+    await update.message.reply_text(
+        "📈 Ваш прогресс:\n\n"
+        f"🎯 Заданий получено: {progress['tasks_shown']}, выполнено: {progress['tasks_completed']}\n"
+        f"📔 Записей в дневнике: {progress['diary_entries']}\n"
+        f"🔥 Текущая серия: {current_streak} дн.\n"
+        f"🏆 Лучшая серия: {progress['longest_streak']} дн.\n\n"
+        "Продолжайте в том же духе!"
+    )
 
-# Ключи API
-TELEGRAM_TOKEN = ""  # Токен вашего Telegram бота от BotFather
-API_KEY = ""  # Ваш API ключ OpenRouter
-MODEL = "deepseek/deepseek-r1"
+def archive_path(month):
+    """Путь к архивному файлу за месяц (month в формате ГГГГ-ММ)."""
+    return os.path.join(current_profile().archive_dir, f"interactions-{month}.ndjson.gz")
 
-# ID админа, куда будет отправляться обратная связь
-ADMIN_ID = 1097981276  # Замените на ваш Telegram ID
+def archive_old_interactions(conn):
+    """
+    Переносит взаимодействия старше RETENTION_DAYS в помесячные архивы NDJSON (gzip)
+    и удаляет их из основной БД. Возвращает количество перенесенных строк и список месяцев.
+    """
+    if not RETENTION_DAYS:
+        return 0, []
 
-# Режим форматирования:
-# "parse" - обрабатывать Markdown
-# "strip" - удалять символы форматирования
-FORMATTING_MODE = "strip"  # Рекомендую использовать "strip" для удаления символов форматирования
+    os.makedirs(current_profile().archive_dir, exist_ok=True)
+    cutoff = f"-{int(RETENTION_DAYS)} days"
+    archived = 0
+    months = set()
 
-# Создаем семафор для ограничения одновременных запросов к API
-API_SEMAPHORE = asyncio.Semaphore(10)  # Позволяет до 10 одновременных запросов
+    while True:
+        rows = conn.execute('''
+            SELECT id, user_id, username, user_message, bot_response, timestamp
+            FROM interactions
+            WHERE timestamp < datetime('now', ?)
+            ORDER BY id
+            LIMIT ?
+        ''', (cutoff, ARCHIVE_BATCH_SIZE)).fetchall()
 
-def remove_thinking(content):
-    """Удаление размышлений из контента."""
-    # Удаление тегов <think>
-    content = content.replace('<think>', '').replace('</think>', '')
-    
-    # Удаление характерных размышлений DeepSeek
-    
-    # Паттерн 1: Удаление текста между "Размышление:" и "Ответ:"
-    if "Размышление:" in content and "Ответ:" in content:
-        try:
-            parts = content.split("Ответ:", 1)
-            if len(parts) > 1:
-                content = parts[1].strip()
-        except:
-            pass
-    
-    # Паттерн 2: Удаление английских версий
-    if "Reasoning:" in content and "Answer:" in content:
+        if not rows:
+            break
+
+        # Группируем строки по месяцам
+        batches = {}
+        for row in rows:
+            batches.setdefault(str(row[5])[:7], []).append(row)
+
+        # Сначала пишем в архив, затем удаляем - при сбое строки не теряются
+        for month, month_rows in batches.items():
+            # Режим дозаписи создает новый gzip-член, файл остается читаемым целиком
+            with gzip.open(archive_path(month), 'at', encoding='utf-8') as archive_file:
+                for row_id, user_id, username, user_message, bot_response, timestamp in month_rows:
+                    archive_file.write(json.dumps({
+                        "id": row_id,
+                        "user_id": user_id,
+                        "username": username,
+                        "user_message": user_message,
+                        "bot_response": bot_response,
+                        "timestamp": timestamp
+                    }, ensure_ascii=False) + "\n")
+            months.add(month)
+
+        conn.executemany("DELETE FROM interactions WHERE id = ?", [(row[0],) for row in rows])
+        conn.commit()
+        archived += len(rows)
+
+    return archived, sorted(months)
+
+def read_archived_interactions(start_month=None, end_month=None, user_id=None):
+    """
+    Генератор записей из архива. Месяцы указываются в формате ГГГГ-ММ включительно.
+    Строки, записанные повторно после прерванного обслуживания, отдаются один раз.
+    """
+    archive_dir = current_profile().archive_dir
+    if not os.path.isdir(archive_dir):
+        return
+
+    for filename in sorted(os.listdir(archive_dir)):
+        match = re.fullmatch(r'interactions-(\d{4}-\d{2})\.ndjson\.gz', filename)
+        if not match:
+            continue
+        month = match.group(1)
+        if (start_month and month < start_month) or (end_month and month > end_month):
+            continue
+
+        seen_ids = set()
+        with gzip.open(os.path.join(archive_dir, filename), 'rt', encoding='utf-8') as archive_file:
+            for line in archive_file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record["id"] in seen_ids:
+                    continue
+                seen_ids.add(record["id"])
+                if user_id is not None and record["user_id"] != user_id:
+                    continue
+                yield record
+
+def run_database_maintenance():
+    """
+    Синхронное обслуживание БД: архивация, incremental vacuum, PRAGMA optimize и контрольная точка WAL.
+    Возвращает отчет о проделанной работе.
+    """
+    db_path = current_profile().db_path
+    started = time.monotonic()
+    size_before = os.path.getsize(db_path) if os.path.exists(db_path) else 0
+    report = {}
+
+    try:
+        conn = sqlite3.connect(db_path)
+
+        report["archived"], report["months"] = archive_old_interactions(conn)
+
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA freelist_count")
+        report["free_pages"] = cursor.fetchone()[0]
+        # executescript выполняет PRAGMA до конца, execute освобождает лишь одну страницу за шаг
+        conn.executescript("PRAGMA incremental_vacuum; PRAGMA optimize;")
+
+        wal_path = db_path + '-wal'
+        report["wal_size"] = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+        cursor.execute(f"PRAGMA wal_checkpoint({WAL_CHECKPOINT_MODE})")
+        report["wal_busy"] = bool(cursor.fetchone()[0])
+
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+    report["size_before"] = size_before
+    report["size_after"] = os.path.getsize(db_path)
+    report["duration"] = time.monotonic() - started
+    return report
+
+def format_maintenance_report(report):
+    """Текст отчета об обслуживании БД."""
+    months = ', '.join(report["months"]) or '—'
+    return (
+        "🧹 Обслуживание базы данных завершено\n\n"
+        f"📦 Перенесено в архив: {report['archived']} (месяцы: {months})\n"
+        f"🗑 Освобождено страниц: {report['free_pages']}\n"
+        f"💾 Размер БД: {report['size_before'] // 1024} КБ → {report['size_after'] // 1024} КБ\n"
+        f"📝 WAL: {report['wal_size'] // 1024} КБ перенесено в БД"
+        f"{' (БД занята)' if report['wal_busy'] else ''}\n"
+        f"⏱ Время: {report['duration']:.1f} с"
+    )
+
+async def database_maintenance_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическое обслуживание БД в JobQueue, выполняется вне цикла событий."""
+    try:
+        report = await asyncio.to_thread(run_database_maintenance)
+    except Exception as e:
+        logger.error(f"❌ Ошибка обслуживания базы данных: {e}")
+        return
+
+    logger.info(f"🧹 Обслуживание БД: {report}")
+    # Сообщаем администратору только если что-то изменилось
+    admin_id = current_profile().admin_id
+    if admin_id and (report["archived"] or report["free_pages"]):
         try:
-            parts = content.split("Answer:", 1)
-            if len(parts) > 1:
-                content = parts[1].strip()
-        except:
-            pass
-            
-    # Паттерн 3: Другие варианты начала размышлений
-    thinking_patterns = [
-        "Let me think through this",
-        "Let me think about",
+            await context.bot.send_message(admin_id, format_maintenance_report(report))
+        except Exception as e:
+            logger.error(f"Не удалось отправить отчет администратору: {str(e)}")
+
+async def maintenance_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ручной запуск обслуживания БД администратором (/maintenance)."""
+    if update.effective_user.id != current_profile().admin_id:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+
+    await update.message.reply_text("🧹 Запускаю обслуживание базы данных...")
+    try:
+        report = await asyncio.to_thread(run_database_maintenance)
+    except Exception as e:
+        logger.error(f"❌ Ошибка обслуживания базы данных: {e}")
+        await update.message.reply_text("❌ Не удалось выполнить обслуживание базы данных.")
+        return
+
+    await update.message.reply_text(format_maintenance_report(report))
+
+def parse_export_args(args):
+    """
+    Разбор аргументов /export: формат (csv или ndjson), from=ГГГГ-ММ-ДД, to=ГГГГ-ММ-ДД, user=ID.
+    Возвращает словарь параметров или None при ошибке.
+    """
+    params = {"format": "csv", "date_from": None, "date_to": None, "user_id": None}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if not value and key.lower() in ("csv", "ndjson"):
+            params["format"] = key.lower()
+        elif key in ("from", "to") and re.fullmatch(r'\d{4}-\d{2}-\d{2}', value):
+            params["date_from" if key == "from" else "date_to"] = value
+        elif key == "user" and value.isdigit():
+            params["user_id"] = int(value)
+        else:
+            return None
+    return params
+
+def iter_export_rows(date_from=None, date_to=None, user_id=None):
+    """
+    Генератор строк для экспорта: сначала архив, затем основная БД.
+    БД открывается только для чтения и читается пачками, чтобы не держать таблицу в памяти.
+    """
+    # Архивные записи за нужные месяцы
+    for record in read_archived_interactions(
+        start_month=date_from[:7] if date_from else None,
+        end_month=date_to[:7] if date_to else None,
+        user_id=user_id
+    ):
+        day = str(record["timestamp"])[:10]
+        if (date_from and day < date_from) or (date_to and day > date_to):
+            continue
+        yield [record[field] for field in EXPORT_FIELDS]
+
+    conditions = []
+    params = []
+    if date_from:
+        conditions.append("timestamp >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("timestamp < date(?, '+1 day')")
+        params.append(date_to)
+    if user_id is not None:
+        conditions.append("user_id = ?")
+        params.append(user_id)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    try:
+        # Соединение только для чтения не блокирует запись в WAL-режиме
+        conn = sqlite3.connect(f"file:{current_profile().db_path}?mode=ro", uri=True)
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT {', '.join(EXPORT_FIELDS)}
+            FROM interactions
+            {where}
+            ORDER BY id
+        ''', params)
+
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield list(row)
+
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+def write_export_file(export_format, date_from=None, date_to=None, user_id=None):
+    """
+    Потоковая запись экспорта во временный gzip-файл.
+    Возвращает путь к файлу и количество строк.
+    """
+    export_file = tempfile.NamedTemporaryFile(suffix=f".{export_format}.gz", delete=False)
+    export_file.close()
+    count = 0
+
+    try:
+        with gzip.open(export_file.name, 'wt', encoding='utf-8', newline='') as output:
+            rows = iter_export_rows(date_from, date_to, user_id)
+            if export_format == "csv":
+                writer = csv.writer(output)
+                writer.writerow(EXPORT_FIELDS)
+                for row in rows:
+                    writer.writerow(row)
+                    count += 1
+            else:
+                for row in rows:
+                    output.write(json.dumps(dict(zip(EXPORT_FIELDS, row)), ensure_ascii=False) + "\n")
+                    count += 1
+    except Exception:
+        os.remove(export_file.name)
+        raise
+
+    return export_file.name, count
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Выгрузка взаимодействий администратору в виде сжатого файла.
+    Использование: /export [csv|ndjson] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] [user=ID]
+    """
+    if update.effective_user.id != current_profile().admin_id:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+
+    params = parse_export_args(context.args or [])
+    if params is None:
+        await update.message.reply_text(
+            "Использование: /export [csv|ndjson] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] [user=ID]"
+        )
+        return
+
+    await update.message.reply_text("📤 Готовлю выгрузку...")
+    try:
+        path, count = await asyncio.to_thread(
+            write_export_file, params["format"], params["date_from"], params["date_to"], params["user_id"]
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка экспорта: {e}")
+        await update.message.reply_text("❌ Не удалось выполнить выгрузку.")
+        return
+
+    if os.path.getsize(path) > EXPORT_MAX_FILE_SIZE:
+        size_mb = os.path.getsize(path) / (1024 * 1024)
+        os.remove(path)
+        await update.message.reply_text(
+            f"❌ Файл выгрузки слишком большой ({size_mb:.1f} МБ при лимите Telegram "
+            f"{EXPORT_MAX_FILE_SIZE // (1024 * 1024)} МБ). Сузьте период (from=, to=) или укажите user=ID."
+        )
+        return
+
+    try:
+        filename = f"interactions-{time.strftime('%Y%m%d-%H%M%S')}.{params['format']}.gz"
+        with open(path, 'rb') as document:
+            await update.message.reply_document(
+                document,
+                filename=filename,
+                caption=f"📤 Выгружено записей: {count}"
+            )
+    except Exception as e:
+        logger.error(f"❌ Не удалось отправить выгрузку: {e}")
+        await update.message.reply_text("❌ Не удалось отправить файл выгрузки.")
+    finally:
+        os.remove(path)
+
+# Счетчики работы бота (необработанные нажатия, ошибки и т.п.)
+METRICS = Counter()
+
+# Формат callback_data: "<версия>:<раздел>:<действие>[:<аргумент>]", не длиннее 64 байт
+CALLBACK_VERSION = "1"
+
+# Кнопки из сообщений, отправленных до введения нового формата
+LEGACY_CALLBACKS = {
+    'new_task': ('task', 'new', None),
+    'task_completed': ('task', 'done', None),
+    'set_admin': ('admin', 'claim', None),
+    'feedback_good': ('fb', 'good', None),
+    'feedback_bad': ('fb', 'bad', None),
+    'reason_inaccurate': ('fb', 'reason', 'inaccurate'),
+    'reason_unclear': ('fb', 'reason', 'unclear'),
+    'reason_short': ('fb', 'reason', 'short'),
+    'reason_long': ('fb', 'reason', 'long'),
+    'reason_other': ('fb', 'reason', 'other'),
+    'add_comment': ('fb', 'comment', None),
+    'admin_stats': ('adm', 'stats', None),
+    'admin_users': ('adm', 'users', None),
+    'admin_logs': ('adm', 'logs', None),
+    'admin_settings': ('adm', 'settings', None),
+    'admin_usage': ('adm', 'usage', None),
+    'change_model': ('adm', 'model', None),
+    'change_formatting': ('adm', 'formatting', None),
+    'back_to_admin_panel': ('adm', 'panel', None)
+}
+
+def make_callback_data(namespace, action, arg=None):
+    """Кодирует данные кнопки в компактную строку."""
+    parts = [CALLBACK_VERSION, namespace, action]
+    if arg is not None:
+        parts.append(str(arg))
+    return ':'.join(parts)
+
+def parse_callback_data(data):
+    """Разбирает callback_data в (раздел, действие, аргумент) или None для неизвестного формата."""
+    if data in LEGACY_CALLBACKS:
+        return LEGACY_CALLBACKS[data]
+    parts = (data or '').split(':', 3)
+    if len(parts) < 3 or parts[0] != CALLBACK_VERSION:
+        return None
+    return parts[1], parts[2], parts[3] if len(parts) > 3 else None
+
+# Таблица маршрутов: (раздел, действие) -> (обработчик, только для администратора)
+CALLBACK_ROUTES = {}
+
+def callback_route(namespace, action, admin_only=False):
+    """Декоратор регистрации обработчика кнопки."""
+    def decorator(handler):
+        CALLBACK_ROUTES[(namespace, action)] = (handler, admin_only)
+        return handler
+    return decorator
+
+async def dispatch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Единая точка обработки нажатий на инлайн-кнопки: один поиск в таблице маршрутов."""
+    query = update.callback_query
+    await query.answer()  # Отвечаем на запрос, чтобы убрать индикатор загрузки
+
+    parsed = parse_callback_data(query.data)
+    route = CALLBACK_ROUTES.get(parsed[:2]) if parsed else None
+    if route is None:
+        METRICS['callback_unhandled'] += 1
+        logger.warning(f"⚠️ Необработанное нажатие кнопки: {query.data}")
+        return
+
+    handler, admin_only = route
+    if admin_only and update.effective_user.id != current_profile().admin_id:
+        METRICS['callback_denied'] += 1
+        await query.edit_message_text("❌ У вас нет доступа к административной панели.")
+        return
+
+    METRICS['callback_handled'] += 1
+    await handler(update, context, parsed[2])
+
+# Клавиатуры и шаблоны сообщений строятся один раз при запуске
+TASK_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Другое задание", callback_data=make_callback_data('task', 'new'))],
+    [InlineKeyboardButton("✅ Задание выполнено", callback_data=make_callback_data('task', 'done'))]
+])
+SET_ADMIN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Да, я хочу получать фидбек", callback_data=make_callback_data('admin', 'claim'))]
+])
+FEEDBACK_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("👍 Хорошо", callback_data=make_callback_data('fb', 'good')),
+        InlineKeyboardButton("👎 Плохо", callback_data=make_callback_data('fb', 'bad'))
+    ]
+])
+FEEDBACK_REASON_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Неточный ответ", callback_data=make_callback_data('fb', 'reason', 'inaccurate')),
+        InlineKeyboardButton("Непонятно", callback_data=make_callback_data('fb', 'reason', 'unclear'))
+    ],
+    [
+        InlineKeyboardButton("Слишком кратко", callback_data=make_callback_data('fb', 'reason', 'short')),
+        InlineKeyboardButton("Слишком длинно", callback_data=make_callback_data('fb', 'reason', 'long'))
+    ],
+    [
+        InlineKeyboardButton("Другое", callback_data=make_callback_data('fb', 'reason', 'other'))
+    ]
+])
+FEEDBACK_REASONS = {
+    'inaccurate': "Неточный ответ",
+    'unclear': "Непонятный ответ",
+    'short': "Слишком краткий ответ",
+    'long': "Слишком длинный ответ",
+    'other': "Другое"
+}
+ADD_COMMENT_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Добавить комментарий", callback_data=make_callback_data('fb', 'comment'))]
+])
+ADMIN_PANEL_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📊 Статистика", callback_data=make_callback_data('adm', 'stats')),
+        InlineKeyboardButton("👥 Пользователи", callback_data=make_callback_data('adm', 'users'))
+    ],
+    [
+        InlineKeyboardButton("📝 Логи", callback_data=make_callback_data('adm', 'logs')),
+        InlineKeyboardButton("🛠 Настройки", callback_data=make_callback_data('adm', 'settings'))
+    ],
+    [
+        InlineKeyboardButton("💰 Расход токенов", callback_data=make_callback_data('adm', 'usage')),
+        InlineKeyboardButton("🧭 Маршрутизация", callback_data=make_callback_data('adm', 'routing'))
+    ]
+])
+ADMIN_SETTINGS_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🔄 Сменить модель", callback_data=make_callback_data('adm', 'model')),
+        InlineKeyboardButton("📝 Режим форматирования", callback_data=make_callback_data('adm', 'formatting'))
+    ],
+    [
+        InlineKeyboardButton("🔙 Назад", callback_data=make_callback_data('adm', 'panel'))
+    ]
+])
+
+TASK_TEMPLATE = (
+    "🎯 *Ваше задание*:\n\n{task}\n\n"
+    "Выполнение таких заданий поможет вам сократить виртуальное общение "
+    "и развить навыки реального общения."
+)
+TASK_COMPLETED_TEXT = (
+    "🎉 *Отлично! Задание выполнено!*\n\n"
+    "Вы делаете важные шаги к сокращению виртуального общения в пользу живого!🎯"
+    "Продолжайте в том же духе!\n\n"
+    "Хотите получить новое задание? Используйте команду /task"
+)
+
+# Кэш текстов административной панели: повторные нажатия в течение TTL не выполняют SQL.
+# У каждого бота свой кэш (BotProfile.admin_text_cache)
+ADMIN_CACHE_TTL = 15  # секунд
+
+def get_cached_admin_text(key, builder):
+    """Возвращает текст из кэша или строит его заново функцией builder."""
+    admin_text_cache = current_profile().admin_text_cache
+    now = time.monotonic()
+    cached = admin_text_cache.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+    text = builder()
+    admin_text_cache[key] = (now + ADMIN_CACHE_TTL, text)
+    return text
+
+def read_tasks():
+    """Читает задания из файла заданий бота (перечитывает только при изменении файла)"""
+    profile = current_profile()
+    tasks_path = profile.tasks_path
+    tasks_cache = profile.tasks_cache
+    try:
+        if os.path.exists(tasks_path):
+            mtime = os.path.getmtime(tasks_path)
+            if tasks_cache["tasks"] and tasks_cache["mtime"] == mtime:
+                return tasks_cache["tasks"]
+        
+        if not os.path.exists(tasks_path):
+            logger.error(f"❌ Файл с заданиями не найден: {tasks_path}")
+            return ["Выполни простое задание: улыбнись!"]
+        
+        with open(tasks_path, 'r', encoding='utf-8') as file:
+            tasks = file.read().splitlines()
+        
+        # Фильтруем пустые строки
+        tasks = [task for task in tasks if task.strip()]
+        
+        if not tasks:
+            logger.warning("⚠️ Файл с заданиями пуст")
+            return ["Выполни простое задание: улыбнись!"]
+        
+        tasks_cache["mtime"] = mtime
+        tasks_cache["tasks"] = tasks
+        return tasks
+    
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения файла заданий: {e}")
+        return ["Выполни простое задание: улыбнись!"]
+
+async def task_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отправляет пользователю случайное задание."""
+    tasks = read_tasks()
+    random_task = random.choice(tasks)
+    record_event(update.effective_user.id, 'task_shown', {"task": random_task})
+    
+    await update.message.reply_text(
+        TASK_TEMPLATE.format(task=random_task),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=TASK_KEYBOARD
+    )
+    
+@callback_route('task', 'new')
+async def new_task_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Кнопка "Другое задание"."""
+    tasks = read_tasks()
+    random_task = random.choice(tasks)
+    record_event(update.effective_user.id, 'task_shown', {"task": random_task})
+    
+    await update.callback_query.edit_message_text(
+        TASK_TEMPLATE.format(task=random_task),
+        parse_mode=ParseMode.MARKDOWN,
+        reply_markup=TASK_KEYBOARD
+    )
+
+@callback_route('task', 'done')
+async def task_completed_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Кнопка "Задание выполнено"."""
+    # Выполнение задания - событие прогресса, а не запись в истории диалога
+    record_event(update.effective_user.id, 'task_completed')
+    
+    # Send a completion message with encouragement
+    await update.callback_query.edit_message_text(TASK_COMPLETED_TEXT, parse_mode=ParseMode.MARKDOWN)
+
+# Настройка логирования
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Ключи API
+TELEGRAM_TOKEN = ""  # Токен вашего Telegram бота от BotFather
+API_KEY = ""  # Ваш API ключ OpenRouter
+MODEL = "deepseek/deepseek-r1"
+# Модели, между которыми администратор может переключаться в настройках
+MODEL_OPTIONS = ["deepseek/deepseek-r1", "deepseek/deepseek-chat"]
+# Быстрая модель без рассуждений для коротких и простых сообщений
+FAST_MODEL = "deepseek/deepseek-chat"
+
+# ID админа, куда будет отправляться обратная связь
+ADMIN_ID = 1097981276  # Замените на ваш Telegram ID
+
+# Режим форматирования:
+# "parse" - обрабатывать Markdown
+# "strip" - удалять символы форматирования
+FORMATTING_MODE = "strip"  # Рекомендую использовать "strip" для удаления символов форматирования
+
+# Создаем семафор для ограничения одновременных запросов к API
+API_SEMAPHORE = asyncio.Semaphore(10)  # Позволяет до 10 одновременных запросов
+
+# Общий HTTP-клиент для OpenRouter: соединения переиспользуются всеми запросами и всеми ботами процесса
+LLM_SESSION = requests.Session()
+LLM_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=10))
+
+# Параллельная обработка обновлений Telegram
+MAX_CONCURRENT_UPDATES = 32  # Сколько обновлений обрабатывается одновременно
+MAX_PENDING_UPDATES = 512  # Сколько обновлений может ждать обработки, остальные отклоняются
+OVERLOAD_NOTICE_INTERVAL = 60  # Не чаще раза в столько секунд сообщать пользователю о перегрузке
+
+# Фоновые задачи ответов на сообщения
+MAX_MESSAGE_JOBS = 100  # Сколько сообщений может обрабатываться одновременно
+SHUTDOWN_DRAIN_TIMEOUT = 25  # Сколько секунд ждать завершения задач при остановке бота
+JOBS_JOURNAL_PATH = os.path.join(BASE_DIR, 'pending_jobs.json')  # Незавершенные задачи между перезапусками
+
+# Несколько ботов в одном процессе. Если файл существует, боты запускаются по нему (формат см. в load_bot_profiles),
+# иначе запускается один бот с настройками этого файла
+BOTS_CONFIG_PATH = os.path.join(BASE_DIR, 'bots.json')
+
+# Рассылка объявлений
+BROADCAST_RATE = 25  # Сообщений в секунду (общий лимит Telegram - 30)
+BROADCAST_BATCH_SIZE = 50  # Сколько получателей читать из БД за раз (после каждой пачки сохраняется прогресс)
+BROADCAST_CONCURRENCY = 10  # Сколько сообщений рассылки отправляется одновременно
+BROADCAST_STATUS_INTERVAL = 5  # Как часто (в секундах) обновлять сообщение о ходе рассылки
+# Ошибки BadRequest, после которых пользователь исключается из рассылок (остальные считаются сбоями отправки)
+BROADCAST_INACTIVE_ERRORS = ("chat not found", "user is deactivated")
+
+# Дневной лимит токенов на пользователя (None - без ограничений, на администратора не действует)
+DAILY_TOKEN_LIMIT = 50000
+
+# Цены моделей в долларах за 1 млн токенов (запрос, ответ) - используются,
+# если OpenRouter не вернул стоимость в блоке usage
+MODEL_PRICES = {
+    "deepseek/deepseek-r1": (0.55, 2.19),
+    "deepseek/deepseek-chat": (0.27, 1.10)
+}
+
+# Маршрутизация сообщений между моделями
+ROUTING_ENABLED = True  # False - все сообщения отправляются в MODEL
+ROUTING_THRESHOLD = 2.0  # Минимальная оценка сложности для отправки в MODEL
+
+# Короткие реплики, на которые бот отвечает сам, без обращения к API
+CANNED_RESPONSES = {
+    "greeting": (
+        {"привет", "приветик", "здравствуй", "здравствуйте", "добрый день", "добрый вечер",
+         "доброе утро", "хай", "hi", "hello"},
+        [
+            "Привет! 👋 Расскажите, как проходит ваш день и сколько времени сегодня ушло на соцсети?",
+            "Здравствуйте! Я рядом. О чем хотите поговорить? Можете начать со слов 'Сегодня я...'"
+        ]
+    ),
+    "thanks": (
+        {"спасибо", "спасибо большое", "благодарю", "спс", "thanks", "thank you"},
+        [
+            "Пожалуйста! 😊 Рад помочь. Возвращайтесь, когда захотите поделиться успехами.",
+            "Всегда пожалуйста! Маленькие шаги каждый день - это уже большой прогресс."
+        ]
+    ),
+    "bye": (
+        {"пока", "до свидания", "до завтра", "спокойной ночи", "bye"},
+        [
+            "До встречи! 🌿 Хорошего вам дня без лишнего экранного времени.",
+            "Пока! Буду ждать ваших новостей о прогрессе."
+        ]
+    )
+}
+
+# Признаки сложности сообщения и их веса (простой линейный классификатор)
+COMPLEX_QUESTION_RE = re.compile(
+    r'\b(почему|зачем|как\s+(мне|быть|справиться|перестать|бросить)|что\s+(\w+\s+){0,2}делать|не\s+знаю|посоветуй|помоги|объясни)',
+    re.IGNORECASE
+)
+ADDICTION_TOPIC_RE = re.compile(
+    r'(зависим|соцсет|социальн\w* сет|тикток|инстаграм|телефон|экранн\w* врем|тревог|одиноч|не могу)',
+    re.IGNORECASE
+)
+# Вес признака, равный ROUTING_THRESHOLD, сам по себе отправляет сообщение в MODEL:
+# вопросы, записи дневника и основная тема бота (зависимость) не упрощаются
+ROUTING_WEIGHTS = {
+    "diary_marker": 3.0,
+    "complex_question": 2.0,
+    "addiction_topic": 2.0,
+    "per_100_chars": 0.5,
+    "multiple_sentences": 0.5
+}
+
+def normalize_short_message(text):
+    """Приводит короткую реплику к виду для поиска в CANNED_RESPONSES."""
+    return re.sub(r'[^\w\s]', '', text.lower()).strip()
+
+def score_message_complexity(text):
+    """Оценка сложности сообщения по признакам ROUTING_WEIGHTS."""
+    score = 0.0
+    if DIARY_MARKER_RE.search(text):
+        score += ROUTING_WEIGHTS["diary_marker"]
+    if COMPLEX_QUESTION_RE.search(text):
+        score += ROUTING_WEIGHTS["complex_question"]
+    if ADDICTION_TOPIC_RE.search(text):
+        score += ROUTING_WEIGHTS["addiction_topic"]
+    if len(re.findall(r'[.!?…]+\s', text)) >= 2:
+        score += ROUTING_WEIGHTS["multiple_sentences"]
+    score += ROUTING_WEIGHTS["per_100_chars"] * len(text) / 100
+    return score
+
+def route_message(text):
+    """
+    Выбор способа ответа: ("canned", текст ответа), ("fast", модель) или ("reasoning", модель).
+    Выполняется локально и не обращается к API.
+    """
+    if not ROUTING_ENABLED:
+        return "reasoning", current_profile().model
+
+    normalized = normalize_short_message(text)
+    for phrases, responses in CANNED_RESPONSES.values():
+        if normalized in phrases:
+            return "canned", random.choice(responses)
+
+    if score_message_complexity(text) >= ROUTING_THRESHOLD:
+        return "reasoning", current_profile().model
+    return "fast", FAST_MODEL
+
+def extract_usage(response_json, model, latency_ms):
+    """Учет запроса по блоку usage из ответа OpenRouter."""
+    usage = response_json.get("usage") or {}
+    prompt_tokens = usage.get("prompt_tokens") or 0
+    # Токены префикса, взятые провайдером из кэша
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    completion_tokens = usage.get("completion_tokens") or 0
+    cost = usage.get("cost")
+    if cost is None:
+        prompt_price, completion_price = MODEL_PRICES.get(model, (0, 0))
+        cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+    return {
+        "model": response_json.get("model") or model,
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": usage.get("total_tokens") or prompt_tokens + completion_tokens,
+        "cost": cost,
+        "latency_ms": latency_ms
+    }
+
+def remove_thinking(content):
+    """Удаление размышлений из контента."""
+    # Удаление тегов <think>
+    content = content.replace('<think>', '').replace('</think>', '')
+    
+    # Удаление характерных размышлений DeepSeek
+    
+    # Паттерн 1: Удаление текста между "Размышление:" и "Ответ:"
+    if "Размышление:" in content and "Ответ:" in content:
+        try:
+            parts = content.split("Ответ:", 1)
+            if len(parts) > 1:
+                content = parts[1].strip()
+        except:
+            pass
+    
+    # Паттерн 2: Удаление английских версий
+    if "Reasoning:" in content and "Answer:" in content:
+        try:
+            parts = content.split("Answer:", 1)
+            if len(parts) > 1:
+                content = parts[1].strip()
+        except:
+            pass
+            
+    # Паттерн 3: Другие варианты начала размышлений
+    thinking_patterns = [
+        "Let me think through this",
+        "Let me think about",
         "Let me reason through",
         "I'll think through",
         "Let's think about",
@@ -354,7 +1471,7 @@ def process_content(content):
     content = remove_thinking(content)
     
     # Затем обрабатываем форматирование
-    if FORMATTING_MODE == "strip":
+    if current_profile().formatting_mode == "strip":
         # Удаление символов форматирования Markdown
         content = re.sub(r'#+\s+', '', content)  # Удаление заголовков
         content = re.sub(r'\*\*', '', content)   # Удаление жирного текста
@@ -364,40 +1481,113 @@ def process_content(content):
         content = re.sub(r'~', '', content)      # Удаление зачеркивания
         # Удаление блоков кода
         content = re.sub(r'```[\s\S]*?```', lambda m: m.group(0).replace('```', ''), content)
-    elif FORMATTING_MODE == "parse":
-        # Экранирование специальных символов для Markdown V2
-        content = content.replace('_', '\\_')
-        content = content.replace('*', '\\*')
-        content = content.replace('[', '\\[')
-        content = content.replace(']', '\\]')
-        content = content.replace('(', '\\(')
-        content = content.replace(')', '\\)')
-        content = content.replace('~', '\\~')
-        content = content.replace('`', '\\`')
-        content = content.replace('>', '\\>')
-        content = content.replace('#', '\\#')
-        content = content.replace('+', '\\+')
-        content = content.replace('-', '\\-')
-        content = content.replace('=', '\\=')
-        content = content.replace('|', '\\|')
-        content = content.replace('{', '\\{')
-        content = content.replace('}', '\\}')
-        content = content.replace('.', '\\.')
-        content = content.replace('!', '\\!')
+    # В режиме "parse" экранирование для Markdown V2 выполняется при отправке каждой части
+    # (build_response_parts), чтобы разбиение на части не разрывало экранирующие последовательности
     
     return content
 
-async def chat_with_deepseek(prompt):
-    """Взаимодействие с API DeepSeek через OpenRouter."""
-    # Используем семафор для ограничения одновременных запросов
-    async with API_SEMAPHORE:
-        headers = {
-            "Authorization": f"Bearer {API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        # Добавляем инструкцию, чтобы модель не делала размышлений
-        system_message = """Пожалуйста, отвечайте на запросы пользователя напрямую, без размышлений, анализа или пошаговых рассуждений. Старайтесь давать развернутые, подробные ответы, объясняя контекст и предоставляя полезную информацию. Избегайте слишком коротких ответов. Твоя основная цель — помогать пользователям преодолевать зависимость от социальных сетей, предоставляя поддержку, стратегии и конструктивные советы. Действуй как заботливый и мудрый наставник, который:
+# Лимит длины сообщения Telegram в единицах UTF-16
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Запас под заголовок "Часть N/M:" в длинных ответах
+PART_HEADER_RESERVE = 32
+# Символы, которые в Markdown V2 должны быть экранированы обратной косой чертой
+MARKDOWN_V2_SPECIAL = '\\_*[]()~`>#+-=|{}.!'
+MARKDOWN_V2_ESCAPE_RE = re.compile('([' + re.escape(MARKDOWN_V2_SPECIAL) + '])')
+# Границы разбиения по убыванию приоритета: абзац, строка, предложение, слово
+SPLIT_BOUNDARIES = [
+    re.compile(r'(?<=\n\n)'),
+    re.compile(r'(?<=\n)'),
+    re.compile(r'(?<=[.!?…][ \t])'),
+    re.compile(r'(?<=[ \t])')
+]
+
+def utf16_len(text):
+    """Длина строки в единицах UTF-16, как ее считает Telegram."""
+    return len(text.encode('utf-16-le')) // 2
+
+def escape_markdown_v2(text):
+    """Экранирует все специальные символы Markdown V2, текст отображается как есть."""
+    return MARKDOWN_V2_ESCAPE_RE.sub(r'\\\1', text)
+
+def _split_pieces(text, limit, measure, level=0):
+    """Рекурсивно делит текст по границам SPLIT_BOUNDARIES на куски не длиннее limit."""
+    if measure(text) <= limit:
+        return [text]
+
+    if level >= len(SPLIT_BOUNDARIES):
+        # Границ не осталось - режем по символам
+        pieces = []
+        current = ''
+        current_size = 0
+        for char in text:
+            size = measure(char)
+            if current and current_size + size > limit:
+                pieces.append(current)
+                current, current_size = '', 0
+            current += char
+            current_size += size
+        if current:
+            pieces.append(current)
+        return pieces
+
+    pieces = []
+    for part in SPLIT_BOUNDARIES[level].split(text):
+        if part:
+            pieces.extend(_split_pieces(part, limit, measure, level + 1))
+    return pieces
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT, measure=utf16_len):
+    """
+    Делит текст на части не длиннее limit (по функции measure), стараясь резать
+    по абзацам, затем по строкам, предложениям и словам.
+    measure должна быть аддитивной: measure(a + b) == measure(a) + measure(b).
+    """
+    chunks = []
+    current = ''
+    current_size = 0
+    for piece in _split_pieces(text, limit, measure):
+        size = measure(piece)
+        if current and current_size + size > limit:
+            chunks.append(current)
+            current, current_size = '', 0
+        current += piece
+        current_size += size
+    if current:
+        chunks.append(current)
+
+    # Пробелы на стыках частей не нужны
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+def split_response(text, formatting_mode):
+    """Делит ответ на части с учетом экранирования в режиме "parse" и места под заголовок части."""
+    if formatting_mode == "parse":
+        measure = lambda part: utf16_len(escape_markdown_v2(part))
+    else:
+        measure = utf16_len
+
+    if measure(text) <= TELEGRAM_MESSAGE_LIMIT:
+        return [text]
+    return split_message(text, TELEGRAM_MESSAGE_LIMIT - PART_HEADER_RESERVE, measure)
+
+def build_response_parts(text, formatting_mode):
+    """
+    Готовые к отправке части ответа: с заголовком "Часть N/M" у длинных ответов
+    и с экранированием Markdown V2 в режиме "parse".
+    """
+    chunks = split_response(text, formatting_mode)
+    parts = []
+    for i, chunk in enumerate(chunks):
+        if len(chunks) > 1:
+            chunk = f"Часть {i+1}/{len(chunks)}:\n\n{chunk}"
+        if formatting_mode == "parse":
+            chunk = escape_markdown_v2(chunk)
+        parts.append(chunk)
+    return parts
+
+# Добавляем инструкцию, чтобы модель не делала размышлений.
+# Статический префикс запроса: строится один раз и не меняется между вызовами,
+# поэтому провайдер может кэшировать его обработку
+SYSTEM_PROMPT = """Пожалуйста, отвечайте на запросы пользователя напрямую, без размышлений, анализа или пошаговых рассуждений. Старайтесь давать развернутые, подробные ответы, объясняя контекст и предоставляя полезную информацию. Избегайте слишком коротких ответов. Твоя основная цель — помогать пользователям преодолевать зависимость от социальных сетей, предоставляя поддержку, стратегии и конструктивные советы. Действуй как заботливый и мудрый наставник, который:
 
 1. Внимательно слушает пользователя
 2. Не осуждает, а поддерживает и мотивирует
@@ -424,19 +1614,48 @@ async def chat_with_deepseek(prompt):
 - Работа с underlying психологическими причинами
 
 Важно: Создавай безопасное, доверительное пространство для честного диалога о зависимости."""
+
+# Модели, которым кэшируемый префикс нужно пометить явно (cache_control).
+# DeepSeek и OpenAI кэшируют совпадающий префикс автоматически
+PROMPT_CACHE_CONTROL_PREFIXES = ("anthropic/", "google/gemini")
+
+def build_messages(prompt, model, context_messages=()):
+    """
+    Сообщения запроса: неизменный системный префикс, затем контекст диалога и сообщение пользователя.
+    """
+    profile = current_profile()
+    if model.startswith(PROMPT_CACHE_CONTROL_PREFIXES):
+        system_message = profile.system_message_cache_control
+    else:
+        system_message = profile.system_message
+    return [system_message, *context_messages, {"role": "user", "content": prompt}]
+
+async def chat_with_deepseek(prompt, model=None):
+    """
+    Взаимодействие с API DeepSeek через OpenRouter.
+    model - модель, выбранная маршрутизацией (по умолчанию модель текущего бота).
+    Возвращает текст ответа и учет запроса (None, если запрос не удался).
+    """
+    model = model or current_profile().model
+    # Используем семафор для ограничения одновременных запросов
+    async with API_SEMAPHORE:
+        headers = {
+            "Authorization": f"Bearer {API_KEY}",
+            "Content-Type": "application/json"
+        }
         
         data = {
-            "model": MODEL,
-            "messages": [
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": prompt}
-            ]
+            "model": model,
+            "messages": build_messages(prompt, model),
+            # Просим OpenRouter вернуть стоимость запроса в блоке usage
+            "usage": {"include": True}
         }
 
         try:
-            # Используем асинхронный HTTP клиент вместо requests
+            started = time.monotonic()
+            # Запрос выполняется в отдельном потоке через общую сессию с пулом соединений
             response = await asyncio.to_thread(
-                requests.post,
+                LLM_SESSION.post,
                 "https://openrouter.ai/api/v1/chat/completions",
                 headers=headers,
                 json=data
@@ -444,31 +1663,28 @@ async def chat_with_deepseek(prompt):
             
             if response.status_code != 200:
                 logger.error(f"Ошибка API: {response.status_code}")
-                return "Произошла ошибка при обращении к API. Пожалуйста, попробуйте позже."
+                return "Произошла ошибка при обращении к API. Пожалуйста, попробуйте позже.", None
                 
             response_json = response.json()
+            usage = extract_usage(response_json, model, int((time.monotonic() - started) * 1000))
             content = response_json["choices"][0]["message"].get("content", "")
-            return process_content(content)
+            return process_content(content), usage
         
         except Exception as e:
             logger.error(f"Ошибка: {str(e)}")
-            return "Произошла ошибка при обработке запроса. Пожалуйста, попробуйте еще раз позже."
+            return "Произошла ошибка при обработке запроса. Пожалуйста, попробуйте еще раз позже.", None
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start."""
-    global ADMIN_ID
-    # Если ADMIN_ID не установлен, и сообщение от пользователя,
+    remember_user(update.effective_user.id)
+    # Если администратор не установлен, и сообщение от пользователя,
     # спрашиваем, хочет ли он стать админом
-    if ADMIN_ID is None:
-        keyboard = [
-            [InlineKeyboardButton("Да, я хочу получать фидбек", callback_data='set_admin')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    if current_profile().admin_id is None:
         await update.message.reply_text(
             "Привет! Я бот, использующий новейшую для ответов на ваши вопросы.\n"
             "Просто напишите мне, и я отвечу!\n\n"
             "Хотите ли вы получать фидбек от пользователей?",
-            reply_markup=reply_markup
+            reply_markup=SET_ADMIN_KEYBOARD
         )
     else:
         await update.message.reply_text(
@@ -486,7 +1702,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "2. Используйте /start для начала работы\n"
         "3. Используйте /help для отображения этой справки\n"
         "4. Используйте /feedback для отправки отзыва о работе бота\n\n"
-        "5. Используйте /task для получения интересного задания\n\n"
+        "5. Используйте /task для получения интересного задания\n"
+        "6. Используйте /search <слова> для поиска по вашим прошлым записям\n"
+        "7. Используйте /progress, чтобы увидеть свой прогресс и серию дней\n\n"
         "💡 Кстати, вы можете использовать этот чат как дневник для отслеживания своих достижений. Просто начните сообщение со слов 'Сегодня я...' и опишите свои действия и их результат.\n"
     )
     
@@ -494,211 +1712,337 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def feedback_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /feedback."""
-    keyboard = [
-        [
-            InlineKeyboardButton("👍 Хорошо", callback_data='feedback_good'),
-            InlineKeyboardButton("👎 Плохо", callback_data='feedback_bad')
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
         "Оцените работу бота:",
-        reply_markup=reply_markup
+        reply_markup=FEEDBACK_KEYBOARD
     )
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик обычных сообщений."""
-    user_text = update.message.text
-    user_id = update.effective_user.id
-    chat_id = update.effective_chat.id
-    
-    logger.info(f"Получено сообщение от пользователя {user_id} в чате {chat_id}: {user_text}")
-    
-    # Отправка уведомления о принятии запроса
-    notification = await update.message.reply_text("✅ Принял твои слова. Обдумываю...")
-    
-    # Отправка 'typing...' действия
-    await update.message.chat.send_action(action="typing")
-    
-    # Создаем отдельную задачу для обработки сообщения
-    # Это позволит боту обрабатывать другие сообщения, пока ждет ответ от API
-    task = asyncio.create_task(process_user_message(update, notification, user_text))
-    
-    # Сохраняем задачу в контексте пользователя, чтобы она не была уничтожена сборщиком мусора
-    if 'tasks' not in context.user_data:
-        context.user_data['tasks'] = []
-    context.user_data['tasks'].append(task)
+class MessageJobSupervisor:
+    """
+    Учет фоновых задач ответа на сообщения.
+    Ограничивает их количество, считает ошибки, а при остановке бота дожидается
+    завершения задач и сохраняет незавершенные в журнал для продолжения после перезапуска.
+    """
 
-async def process_user_message(update, notification, user_text):
-    """Обрабатывает сообщение пользователя в отдельной асинхронной задаче."""
-    try:
-        # Получение ответа от DeepSeek
-        response_text = await chat_with_deepseek(user_text)
-        
-        # Логирование взаимодействия
-        user_id = update.effective_user.id
-        username = update.effective_user.username or "Unknown"
-        log_interaction(user_id, username, user_text, response_text)
-        
-        # Разделение длинных ответов на несколько сообщений (лимит Telegram ~4096 символов)
-        max_length = 4000  # Берем с запасом
-        
-        # Удаление предыдущего сообщения о принятии запроса
+    def __init__(self, max_jobs, journal_path):
+        self.max_jobs = max_jobs
+        self.journal_path = journal_path
+        self.accepting = True
+        self._jobs = {}  # задача -> описание задачи
+        self._deferred = []  # задачи, поступившие во время остановки
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def is_full(self):
+        return len(self._jobs) >= self.max_jobs
+
+    def submit(self, bot, job):
+        """Запускает обработку сообщения. Возвращает False, если задачу нельзя принять."""
+        if not self.accepting:
+            # Бот останавливается - задача будет выполнена после перезапуска
+            self._deferred.append(job)
+            return True
+        if self.is_full():
+            METRICS['message_jobs_rejected'] += 1
+            return False
+
+        task = asyncio.create_task(process_user_message(bot, job))
+        self._jobs[task] = job
+        task.add_done_callback(self._on_done)
+        return True
+
+    def _on_done(self, task):
+        self._jobs.pop(task, None)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            METRICS['message_jobs_failed'] += 1
+            logger.error(f"❌ Ошибка фоновой задачи: {error}")
+        elif task.result() is False:
+            # process_user_message сам сообщил пользователю об ошибке
+            METRICS['message_jobs_failed'] += 1
+        else:
+            METRICS['message_jobs_completed'] += 1
+
+    async def drain(self, timeout):
+        """Перестает принимать задачи, ждет завершения текущих и сохраняет оставшиеся в журнал."""
+        self.accepting = False
+        if self._jobs:
+            logger.info(f"⏳ Ожидание завершения {len(self._jobs)} задач (до {timeout} с)...")
+            await asyncio.wait(list(self._jobs), timeout=timeout)
+
+        unfinished = list(self._jobs.items())
+        for task, _ in unfinished:
+            task.cancel()
+        pending = [job for _, job in unfinished] + self._deferred
+        self._deferred = []
+
+        if pending:
+            # Не затираем задачи, уже сохраненные ранее и еще не возобновленные
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'r', encoding='utf-8') as journal:
+                    pending = json.load(journal) + pending
+            with open(self.journal_path, 'w', encoding='utf-8') as journal:
+                json.dump(pending, journal, ensure_ascii=False)
+            METRICS['message_jobs_persisted'] += len(pending)
+            logger.warning(f"💾 Сохранено незавершенных задач: {len(pending)}")
+
+    def resume(self, bot):
+        """Запускает задачи, сохраненные при предыдущей остановке."""
+        if not os.path.exists(self.journal_path):
+            return 0
         try:
-            await notification.delete()
+            with open(self.journal_path, 'r', encoding='utf-8') as journal:
+                pending = json.load(journal)
         except Exception as e:
-            # Обработка любых исключений, чтобы бот продолжал работать
-            logger.error(f"Ошибка обработки сообщения: {str(e)}")
-            try:
-                await update.message.reply_text("❌ Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз.")
-            except:
-                pass
+            logger.error(f"❌ Не удалось прочитать журнал задач: {e}")
+            pending = []
+        os.remove(self.journal_path)
 
-        
-        # Если ответ короткий, отправляем как есть
-        if len(response_text) <= max_length:
-            if FORMATTING_MODE == "parse":
+        for job in pending:
+            # После перезапуска лимит не применяется - эти пользователи уже ждут ответа
+            task = asyncio.create_task(process_user_message(bot, job))
+            self._jobs[task] = job
+            task.add_done_callback(self._on_done)
+        METRICS['message_jobs_resumed'] += len(pending)
+        logger.info(f"▶️ Возобновлено задач после перезапуска: {len(pending)}")
+        return len(pending)
+
+class BotProfile:
+    """
+    Настройки и состояние одного бота: токен, администратор, модель, режим форматирования,
+    системный промпт, файл заданий, БД с архивом и собственные фоновые задачи.
+    HTTP-клиент LLM, обработка обновлений, постобработка ответов и METRICS общие для всех ботов.
+    """
+
+    def __init__(self, name, token, admin_id=None, model=MODEL, system_prompt=SYSTEM_PROMPT,
+                 tasks_path=TASKS_PATH, db_path=DB_PATH, archive_dir=ARCHIVE_DIR,
+                 jobs_journal_path=JOBS_JOURNAL_PATH, formatting_mode=FORMATTING_MODE):
+        self.name = name
+        self.token = token
+        self.admin_id = admin_id
+        self.model = model
+        self.formatting_mode = formatting_mode
+        self.tasks_path = tasks_path
+        self.db_path = db_path
+        self.archive_dir = archive_dir
+        # Системное сообщение строится один раз, чтобы префикс запроса оставался неизменным для кэша
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.system_message_cache_control = {
+            "role": "system",
+            "content": [
+                {"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}
+            ]
+        }
+        self.jobs = MessageJobSupervisor(MAX_MESSAGE_JOBS, jobs_journal_path)
+        self.broadcast_tasks = {}  # id рассылки -> задача
+        self.tasks_cache = {"mtime": None, "tasks": None}
+        self.admin_text_cache = {}
+
+# Бот с настройками этого файла (режим одного бота)
+DEFAULT_PROFILE = BotProfile("default", TELEGRAM_TOKEN, ADMIN_ID)
+
+# Бот, в контексте которого выполняется текущая задача. Задачи asyncio наследуют значение
+# от создавшей их задачи, поэтому достаточно установить его перед запуском Application
+ACTIVE_PROFILE = contextvars.ContextVar("active_profile")
+
+def current_profile():
+    """Настройки бота, обрабатывающего текущее обновление."""
+    return ACTIVE_PROFILE.get(DEFAULT_PROFILE)
+
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик обычных сообщений."""
+    user_text = update.message.text
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    
+    logger.info(f"Получено сообщение от пользователя {user_id} в чате {chat_id}: {user_text}")
+    
+    # Записи дневника учитываются в прогрессе пользователя
+    if DIARY_MARKER_RE.search(user_text):
+        record_event(user_id, 'diary_entry')
+    
+    # Проверка дневного лимита токенов до постановки запроса в очередь
+    if DAILY_TOKEN_LIMIT and user_id != current_profile().admin_id and get_daily_tokens(user_id) >= DAILY_TOKEN_LIMIT:
+        await update.message.reply_text(
+            "⏳ Вы исчерпали дневной лимит сообщений. Пожалуйста, возвращайтесь завтра!"
+        )
+        return
+    
+    # Локальная маршрутизация: простые реплики получают готовый ответ без обращения к API
+    route, target = route_message(user_text)
+    METRICS[f'route_{route}'] += 1
+    if route == "canned":
+        await update.message.reply_text(target)
+        # Без учета расхода: готовые ответы не должны попадать в число запросов usage_daily
+        log_interaction(user_id, update.effective_user.username or "Unknown", user_text, target)
+        return
+    
+    # Проверка загрузки до отправки уведомления
+    jobs = current_profile().jobs
+    if jobs.accepting and jobs.is_full():
+        METRICS['message_jobs_rejected'] += 1
+        await update.message.reply_text("⏳ Сейчас очень много запросов. Пожалуйста, повторите через минуту.")
+        return
+    
+    # Отправка уведомления о принятии запроса
+    notification = await update.message.reply_text("✅ Принял твои слова. Обдумываю...")
+    
+    # Отправка 'typing...' действия
+    await update.message.chat.send_action(action="typing")
+    
+    # Создаем отдельную задачу для обработки сообщения
+    # Это позволит боту обрабатывать другие сообщения, пока ждет ответ от API.
+    # Описание задачи сериализуемо, чтобы ее можно было сохранить при остановке бота
+    job = {
+        "chat_id": chat_id,
+        "user_id": user_id,
+        "username": update.effective_user.username or "Unknown",
+        "text": user_text,
+        "model": target,
+        "notification_id": notification.message_id
+    }
+    if not jobs.submit(context.bot, job):
+        await notification.edit_text("⏳ Сейчас очень много запросов. Пожалуйста, повторите через минуту.")
+
+async def process_user_message(bot, job):
+    """
+    Обрабатывает сообщение пользователя в отдельной асинхронной задаче.
+    Ход выполнения записывается в job: после логирования - готовые части ответа (parts),
+    после отправки каждой части - их количество (sent_parts). Задача, сохраненная при остановке,
+    продолжается с того же места без повторного запроса к API и повторного логирования.
+    Возвращает True, если ответ отправлен полностью.
+    """
+    chat_id = job["chat_id"]
+    user_text = job["text"]
+    try:
+        if "parts" not in job:
+            # Получение ответа от модели, выбранной маршрутизацией
+            response_text, usage = await chat_with_deepseek(user_text, job.get("model"))
+            
+            # Логирование взаимодействия вместе с расходом токенов
+            log_interaction(job["user_id"], job["username"], user_text, response_text, usage)
+            
+            # Разделение длинных ответов по границам абзацев и предложений (лимит Telegram 4096 единиц UTF-16)
+            formatting_mode = current_profile().formatting_mode
+            job["parse_mode"] = ParseMode.MARKDOWN_V2 if formatting_mode == "parse" else None
+            job["parts"] = build_response_parts(response_text, formatting_mode)
+            job["sent_parts"] = 0
+            
+            # Удаление предыдущего сообщения о принятии запроса
+            try:
+                await bot.delete_message(chat_id, job["notification_id"])
+            except Exception as e:
+                # Обработка любых исключений, чтобы бот продолжал работать
+                logger.error(f"Ошибка обработки сообщения: {str(e)}")
                 try:
-                    await update.message.reply_text(response_text, parse_mode=ParseMode.MARKDOWN_V2)
-                except Exception as e:
-                    # В случае ошибки парсинга Markdown, отправляем без форматирования
-                    logger.warning(f"Ошибка парсинга Markdown: {e}")
-                    await update.message.reply_text(response_text)
-            else:
-                await update.message.reply_text(response_text)
-        else:
-            # Разбиваем длинный ответ на части
-            chunks = [response_text[i:i+max_length] for i in range(0, len(response_text), max_length)]
-            for i, chunk in enumerate(chunks):
-                if FORMATTING_MODE == "parse":
-                    try:
-                        await update.message.reply_text(f"Часть {i+1}/{len(chunks)}:\n\n{chunk}", 
-                                                 parse_mode=ParseMode.MARKDOWN_V2)
-                    except Exception as e:
-                        # В случае ошибки парсинга Markdown, отправляем без форматирования
-                        logger.warning(f"Ошибка парсинга Markdown: {e}")
-                        await update.message.reply_text(f"Часть {i+1}/{len(chunks)}:\n\n{chunk}")
-                else:
-                    await update.message.reply_text(f"Часть {i+1}/{len(chunks)}:\n\n{chunk}")
-                
-                # Небольшая задержка между отправкой частей сообщения
-                if i < len(chunks) - 1:
-                    await asyncio.sleep(0.3)  # Задержка 300 мс между сообщениями
+                    await bot.send_message(chat_id, "❌ Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз.")
+                except:
+                    pass
+
+        parts = job["parts"]
+        for i in range(job["sent_parts"], len(parts)):
+            await bot.send_message(chat_id, parts[i], parse_mode=job["parse_mode"])
+            job["sent_parts"] = i + 1
+            
+            # Небольшая задержка между отправкой частей сообщения
+            if i < len(parts) - 1:
+                await asyncio.sleep(0.3)  # Задержка 300 мс между сообщениями
+        return True
                     
     except Exception as e:
-        # Обработка любых исключений, чтобы бот продолжал работать
+        # Обработка любых исключений, чтобы бот продолжал работать.
+        # Ошибка учитывается в MessageJobSupervisor._on_done по результату задачи
         logger.error(f"Ошибка обработки сообщения: {str(e)}")
         try:
-            await update.message.reply_text("❌ Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз.")
+            await bot.send_message(chat_id, "❌ Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте еще раз.")
         except:
             pass
+        return False
 
-async def handle_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик нажатий на инлайн-кнопки."""
-    query = update.callback_query
-    await query.answer()  # Отвечаем на запрос, чтобы убрать индикатор загрузки
-    
-    # Получаем данные из кнопки
-    data = query.data
+async def resume_message_jobs(application):
+    """post_init: продолжение задач и рассылок, прерванных предыдущей остановкой."""
+    current_profile().jobs.resume(application.bot)
+    await resume_broadcasts(application)
+
+async def drain_message_jobs(application):
+    """post_stop: обновления больше не поступают, дожидаемся ответов или сохраняем задачи."""
+    await current_profile().jobs.drain(SHUTDOWN_DRAIN_TIMEOUT)
+
+async def notify_admin(context, text):
+    """Отправка уведомления администратору."""
+    admin_id = current_profile().admin_id
+    if not admin_id:
+        return
+    try:
+        await context.bot.send_message(admin_id, text)
+    except Exception as e:
+        logger.error(f"Не удалось отправить уведомление администратору: {str(e)}")
+
+@callback_route('admin', 'claim')
+async def set_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Назначение администратора из приветствия /start (только пока администратор не задан)."""
+    profile = current_profile()
+    if profile.admin_id is not None:
+        await update.callback_query.edit_message_text("❌ Администратор уже назначен.")
+        return
+    profile.admin_id = update.effective_user.id
+    await update.callback_query.edit_message_text(
+        "✅ Вы настроены как админ для получения обратной связи.\n\n"
+        "Теперь можете использовать бота для получения ответов от DeepSeek-R1."
+    )
+
+@callback_route('fb', 'good')
+async def feedback_good_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Положительный отзыв: благодарим пользователя и уведомляем администратора."""
     user_id = update.effective_user.id
     username = update.effective_user.username or "Unknown"
+    await update.callback_query.edit_message_text("Спасибо за положительный отзыв!", reply_markup=ADD_COMMENT_KEYBOARD)
+    record_event(user_id, 'feedback', {"rating": "good"})
     
-    if data == 'set_admin':
-        global ADMIN_ID
-        ADMIN_ID = user_id
-        await query.edit_message_text(
-            "✅ Вы настроены как админ для получения обратной связи.\n\n"
-            "Теперь можете использовать бота для получения ответов от DeepSeek-R1."
-        )
-        return
+    await notify_admin(context, (
+        f"📊 Новый положительный отзыв!\n\n"
+        f"👤 Пользователь: {username} (ID: {user_id})\n"
+    ))
+
+@callback_route('fb', 'bad')
+async def feedback_bad_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Отрицательный отзыв: просим уточнить проблему."""
+    await update.callback_query.edit_message_text("Что именно вам не понравилось?", reply_markup=FEEDBACK_REASON_KEYBOARD)
+
+@callback_route('fb', 'reason')
+async def feedback_reason_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Обработка причины отрицательного отзыва."""
+    user_id = update.effective_user.id
+    username = update.effective_user.username or "Unknown"
+    reason = FEEDBACK_REASONS.get(arg, "Неизвестная причина")
     
-    # ПРОБЛЕМНЫЙ БЛОК: Обработка обратной связи
-    if data.startswith('feedback_'):
-        # Определяем тип обратной связи
-        if data == 'feedback_good':
-            # Для положительной обратной связи просто благодарим пользователя
-            keyboard = [
-                [InlineKeyboardButton("📝 Добавить комментарий", callback_data='add_comment')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Спасибо за положительный отзыв!", reply_markup=reply_markup)
-            
-            # Отправляем уведомление администратору
-            if ADMIN_ID:
-                feedback_text = (
-                    f"📊 Новый положительный отзыв!\n\n"
-                    f"👤 Пользователь: {username} (ID: {user_id})\n"
-                )
-                try:
-                    await context.bot.send_message(ADMIN_ID, feedback_text)
-                except Exception as e:
-                    logger.error(f"Не удалось отправить уведомление администратору: {str(e)}")
-        
-        elif data == 'feedback_bad':
-            # Для отрицательной обратной связи просим уточнить проблему
-            keyboard = [
-                [
-                    InlineKeyboardButton("Неточный ответ", callback_data='reason_inaccurate'),
-                    InlineKeyboardButton("Непонятно", callback_data='reason_unclear')
-                ],
-                [
-                    InlineKeyboardButton("Слишком кратко", callback_data='reason_short'),
-                    InlineKeyboardButton("Слишком длинно", callback_data='reason_long')
-                ],
-                [
-                    InlineKeyboardButton("Другое", callback_data='reason_other')
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Что именно вам не понравилось?", reply_markup=reply_markup)
-        
-        return
+    # Запрашиваем дополнительный комментарий
+    await update.callback_query.edit_message_text(f"Спасибо за ваш отзыв! Причина: {reason}", reply_markup=ADD_COMMENT_KEYBOARD)
+    record_event(user_id, 'feedback', {"rating": "bad", "reason": arg})
     
-    if data.startswith('reason_'):
-        # Обработка причины отрицательного отзыва
-        reason_map = {
-            'reason_inaccurate': "Неточный ответ",
-            'reason_unclear': "Непонятный ответ",
-            'reason_short': "Слишком краткий ответ",
-            'reason_long': "Слишком длинный ответ",
-            'reason_other': "Другое"
-        }
-        
-        reason = reason_map.get(data, "Неизвестная причина")
-        
-        # Запрашиваем дополнительный комментарий
-        keyboard = [
-            [InlineKeyboardButton("📝 Добавить комментарий", callback_data='add_comment')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(f"Спасибо за ваш отзыв! Причина: {reason}", reply_markup=reply_markup)
-        
-        # Отправляем уведомление администратору
-        if ADMIN_ID:
-            feedback_text = (
-                f"⚠️ Новый отрицательный отзыв!\n\n"
-                f"👤 Пользователь: {username} (ID: {user_id})\n"
-                f"📌 Причина: {reason}\n"
-            )
-            try:
-                await context.bot.send_message(ADMIN_ID, feedback_text)
-            except Exception as e:
-                logger.error(f"Не удалось отправить уведомление администратору: {str(e)}")
-                
-        return
+    await notify_admin(context, (
+        f"⚠️ Новый отрицательный отзыв!\n\n"
+        f"👤 Пользователь: {username} (ID: {user_id})\n"
+        f"📌 Причина: {reason}\n"
+    ))
+
+@callback_route('fb', 'comment')
+async def add_comment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Переводит пользователя в режим ввода комментария к отзыву."""
+    query = update.callback_query
+    # Сохраняем в контексте пользователя, что ожидаем от него комментарий
+    context.user_data['awaiting_feedback'] = True
+    context.user_data['feedback_message_id'] = query.message.message_id
     
-    if data == 'add_comment':
-        # Сохраняем в контексте пользователя, что ожидаем от него комментарий
-        context.user_data['awaiting_feedback'] = True
-        context.user_data['feedback_message_id'] = query.message.message_id
-        
-        # Удаляем кнопки и просим оставить комментарий
-        await query.edit_message_text(
-            "Пожалуйста, напишите ваш комментарий к ответу. Ваш отзыв важен для улучшения работы бота.",
-            reply_markup=None
-        )
-        return
+    # Удаляем кнопки и просим оставить комментарий
+    await query.edit_message_text(
+        "Пожалуйста, напишите ваш комментарий к ответу. Ваш отзыв важен для улучшения работы бота.",
+        reply_markup=None
+    )
 
 async def handle_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка комментариев к отзывам"""
@@ -718,37 +2062,34 @@ async def handle_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Благодарим пользователя
     await update.message.reply_text("Спасибо за ваш комментарий! Он поможет улучшить работу бота.")
+    record_event(user_id, 'feedback', {"comment": comment[:1000]})
     
     # Отправляем уведомление администратору
-    if ADMIN_ID:
+    admin_id = current_profile().admin_id
+    if admin_id:
         feedback_text = (
             f"💬 Новый комментарий от пользователя!\n\n"
             f"👤 Пользователь: {username} (ID: {user_id})\n"
             f"📝 Комментарий: {comment}\n"
         )
         try:
-            await context.bot.send_message(ADMIN_ID, feedback_text)
+            await context.bot.send_message(admin_id, feedback_text)
         except Exception as e:
             logger.error(f"Не удалось отправить уведомление администратору: {str(e)}")
 
 async def command_setadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /setadmin для установки ID администратора."""
-    global ADMIN_ID
-    ADMIN_ID = update.effective_user.id
-    await update.message.reply_text(f"✅ Вы установлены как администратор. Ваш ID: {ADMIN_ID}")
-
-# Исправление admin_panel_command
-async def admin_panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Панель администратора."""
-    # Проверяем, является ли пользователь администратором
-    user_id = update.effective_user.id
-    if user_id != ADMIN_ID:
-        await update.message.reply_text("❌ У вас нет доступа к административной панели.")
+    """Обработчик команды /setadmin для установки ID администратора (только пока администратор не задан)."""
+    profile = current_profile()
+    if profile.admin_id is not None:
+        await update.message.reply_text("❌ Администратор уже назначен.")
         return
+    profile.admin_id = update.effective_user.id
+    await update.message.reply_text(f"✅ Вы установлены как администратор. Ваш ID: {update.effective_user.id}")
 
-    # Получаем статистику
+def build_admin_panel_text():
+    """Текст главной страницы административной панели."""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = sqlite3.connect(current_profile().db_path)
         cursor = conn.cursor()
         
         # Статистика пользователей
@@ -776,172 +2117,728 @@ async def admin_panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             LIMIT 5
         ''')
         top_users = cursor.fetchall()
+    
+    finally:
+        if 'conn' in locals():
+            conn.close()
+    
+    # Формируем текст статистики
+    stats_text = (
+        "🤖 <b>Административная панель бота</b> 🤖\n\n"
+        f"📈 Общая статистика:\n"
+        f"👥 Всего пользователей: {total_users}\n"
+        f"💬 Всего взаимодействий: {total_interactions}\n"
+        f"🕒 Взаимодействий за 24 часа: {interactions_last_24h}\n\n"
+        "🏆 Топ-5 активных пользователей:\n"
+    )
+    
+    for i, (user_id, username, count) in enumerate(top_users, 1):
+        stats_text += f"{i}. {html.escape(username or 'Без имени')} (ID: {user_id}): {count} взаимодействий\n"
+    
+    return stats_text
+
+def build_admin_stats_text():
+    """Текст статистики взаимодействий по дням."""
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        cursor = conn.cursor()
         
-        # Создаем клавиатуру для администратора
-        keyboard = [
-            [
-                InlineKeyboardButton("📊 Статистика", callback_data='admin_stats'),
-                InlineKeyboardButton("👥 Пользователи", callback_data='admin_users')
-            ],
-            [
-                InlineKeyboardButton("📝 Логи", callback_data='admin_logs'),
-                InlineKeyboardButton("🛠 Настройки", callback_data='admin_settings')
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Формируем текст статистики
-        stats_text = (
-            "🤖 <b>Административная панель бота</b> 🤖\n\n"
-            f"📈 Общая статистика:\n"
-            f"👥 Всего пользователей: {total_users}\n"
-            f"💬 Всего взаимодействий: {total_interactions}\n"
-            f"🕒 Взаимодействий за 24 часа: {interactions_last_24h}\n\n"
-            "🏆 Топ-5 активных пользователей:\n"
-        )
+        # Статистика по дням
+        cursor.execute('''
+            SELECT 
+                date(timestamp) as interaction_date, 
+                COUNT(*) as daily_interactions 
+            FROM interactions 
+            GROUP BY interaction_date 
+            ORDER BY interaction_date DESC 
+            LIMIT 7
+        ''')
+        daily_stats = cursor.fetchall()
+    
+    finally:
+        if 'conn' in locals():
+            conn.close()
+    
+    stats_text = "📊 Детальная статистика взаимодействий за 7 дней:\n\n"
+    for date, count in daily_stats:
+        stats_text += f"📅 {date}: {count} взаимодействий\n"
+    return stats_text
+
+def build_admin_users_text():
+    """Текст со списком последних активных пользователей."""
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        cursor = conn.cursor()
         
-        for i, (user_id, username, count) in enumerate(top_users, 1):
-            stats_text += f"{i}. {username or 'Без имени'} (ID: {user_id}): {count} взаимодействий\n"
+        cursor.execute('''
+            SELECT DISTINCT user_id, username, MAX(timestamp) as last_interaction 
+            FROM interactions 
+            GROUP BY user_id, username 
+            ORDER BY last_interaction DESC 
+            LIMIT 10
+        ''')
+        recent_users = cursor.fetchall()
+    
+    finally:
+        if 'conn' in locals():
+            conn.close()
+    
+    users_text = "👥 Последние активные пользователи:\n\n"
+    for user_id, username, last_interaction in recent_users:
+        users_text += f"👤 {username or 'Без имени'} (ID: {user_id})\n"
+        users_text += f"🕒 Последнее взаимодействие: {last_interaction}\n\n"
+    return users_text
+
+def build_admin_usage_text():
+    """Расход токенов по дням и самые затратные пользователи (из дневных агрегатов)."""
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        cursor = conn.cursor()
         
-        await update.message.reply_text(stats_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        cursor.execute('''
+            SELECT day, SUM(requests), SUM(total_tokens), SUM(cost), SUM(latency_ms) / MAX(SUM(requests), 1),
+                   SUM(cached_tokens) * 100 / MAX(SUM(prompt_tokens), 1)
+            FROM usage_daily
+            WHERE day >= date('now', '-6 days')
+            GROUP BY day
+            ORDER BY day DESC
+        ''')
+        daily_usage = cursor.fetchall()
+        
+        cursor.execute('''
+            SELECT user_id, SUM(requests), SUM(total_tokens), SUM(cost)
+            FROM usage_daily
+            WHERE day >= date('now', '-6 days')
+            GROUP BY user_id
+            ORDER BY SUM(cost) DESC
+            LIMIT 10
+        ''')
+        top_users = cursor.fetchall()
+    
+    finally:
+        if 'conn' in locals():
+            conn.close()
+    
+    usage_text = "💰 Расход токенов за 7 дней:\n\n"
+    for day, requests_count, tokens, cost, avg_latency, cached_share in daily_usage:
+        usage_text += (
+            f"📅 {day}: {requests_count} запросов, {tokens} токенов, ${cost:.4f}, ~{avg_latency} мс, "
+            f"из кэша {cached_share}%\n"
+        )
+    
+    usage_text += "\n🏆 Самые затратные пользователи:\n"
+    for i, (top_user_id, requests_count, tokens, cost) in enumerate(top_users, 1):
+        usage_text += f"{i}. ID {top_user_id}: {requests_count} запросов, {tokens} токенов, ${cost:.4f}\n"
+    
+    if DAILY_TOKEN_LIMIT:
+        usage_text += f"\n⏳ Дневной лимит: {DAILY_TOKEN_LIMIT} токенов на пользователя"
+    return usage_text
+
+def build_admin_routing_text():
+    """Распределение запросов по моделям и средняя задержка за 7 дней."""
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            SELECT model, COUNT(*), AVG(latency_ms), AVG(total_tokens), SUM(cost)
+            FROM interactions
+            WHERE timestamp >= datetime('now', '-7 days') AND model IS NOT NULL
+            GROUP BY model
+            ORDER BY COUNT(*) DESC
+        ''')
+        models = cursor.fetchall()
+    
+    finally:
+        if 'conn' in locals():
+            conn.close()
+    
+    total = sum(row[1] for row in models) or 1
+    routing_text = "🧭 Маршрутизация запросов за 7 дней:\n\n"
+    for model, count, avg_latency, avg_tokens, cost in models:
+        routing_text += (
+            f"🤖 {model}: {count} ({count * 100 // total}%), "
+            f"~{int(avg_latency or 0)} мс, ~{int(avg_tokens or 0)} токенов, ${cost or 0:.4f}\n"
+        )
+    
+    routing_text += (
+        f"\nС момента запуска: готовых ответов {METRICS['route_canned']}, "
+        f"быстрая модель {METRICS['route_fast']}, {current_profile().model} {METRICS['route_reasoning']}\n"
+        f"Маршрутизация: {'включена' if ROUTING_ENABLED else 'выключена'}"
+    )
+    return routing_text
+
+# Исправление admin_panel_command
+async def admin_panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Панель администратора."""
+    # Проверяем, является ли пользователь администратором
+    user_id = update.effective_user.id
+    if user_id != current_profile().admin_id:
+        await update.message.reply_text("❌ У вас нет доступа к административной панели.")
+        return
+
+    # Получаем статистику (повторные вызовы в течение ADMIN_CACHE_TTL берутся из кэша)
+    try:
+        stats_text = get_cached_admin_text('panel', build_admin_panel_text)
+        await update.message.reply_text(stats_text, reply_markup=ADMIN_PANEL_KEYBOARD, parse_mode=ParseMode.HTML)
     
     except sqlite3.Error as e:
         logger.error(f"Ошибка в административной панели: {e}")
         await update.message.reply_text("❌ Не удалось получить статистику.")
+
+@callback_route('adm', 'panel', admin_only=True)
+async def admin_panel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Кнопка "Назад" - возврат на главную страницу панели."""
+    query = update.callback_query
+    try:
+        stats_text = get_cached_admin_text('panel', build_admin_panel_text)
+        await query.edit_message_text(stats_text, reply_markup=ADMIN_PANEL_KEYBOARD, parse_mode=ParseMode.HTML)
+    
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка в административной панели: {e}")
+        await query.edit_message_text("❌ Не удалось получить статистику.")
+
+@callback_route('adm', 'stats', admin_only=True)
+async def admin_stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Подробная статистика взаимодействий."""
+    query = update.callback_query
+    try:
+        await query.edit_message_text(get_cached_admin_text('stats', build_admin_stats_text))
+    
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения статистики: {e}")
+        await query.edit_message_text("❌ Не удалось получить детальную статистику.")
+
+@callback_route('adm', 'users', admin_only=True)
+async def admin_users_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Список последних активных пользователей."""
+    query = update.callback_query
+    try:
+        await query.edit_message_text(get_cached_admin_text('users', build_admin_users_text))
+    
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения списка пользователей: {e}")
+        await query.edit_message_text("❌ Не удалось получить список пользователей.")
+
+@callback_route('adm', 'usage', admin_only=True)
+async def admin_usage_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Расход токенов по дням и самые затратные пользователи."""
+    query = update.callback_query
+    try:
+        await query.edit_message_text(get_cached_admin_text('usage', build_admin_usage_text))
+    
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения расхода токенов: {e}")
+        await query.edit_message_text("❌ Не удалось получить расход токенов.")
+
+@callback_route('adm', 'routing', admin_only=True)
+async def admin_routing_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Распределение запросов между моделями и его влияние на задержку."""
+    query = update.callback_query
+    try:
+        await query.edit_message_text(get_cached_admin_text('routing', build_admin_routing_text))
+    
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка получения статистики маршрутизации: {e}")
+        await query.edit_message_text("❌ Не удалось получить статистику маршрутизации.")
+
+@callback_route('adm', 'logs', admin_only=True)
+async def admin_logs_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Последние системные логи."""
+    log_content = ""
+    try:
+        with open('bot.log', 'r') as log_file:
+            # Читаем последние 20 строк
+            log_content = ''.join(log_file.readlines()[-20:])
+    except Exception as e:
+        log_content = f"Ошибка чтения логов: {str(e)}"
+    
+    await update.callback_query.edit_message_text(f"🔍 Последние системные логи:\n\n{log_content}")
+
+def build_admin_settings_text():
+    """Текст страницы настроек бота."""
+    return (
+        "🛠 <b>Настройки бота</b>:\n\n"
+        f"🤖 Модель: {current_profile().model}\n"
+        f"⚡ Быстрая модель: {FAST_MODEL if ROUTING_ENABLED else 'не используется'}\n"
+        f"📝 Режим форматирования: {current_profile().formatting_mode}\n"
+        f"📊 Максимальное количество API-запросов: {API_SEMAPHORE._value}\n"
+        f"🔘 Необработанных нажатий кнопок: {METRICS['callback_unhandled']}\n"
+        f"📥 Отклонено обновлений при перегрузке: {METRICS['updates_rejected']}\n"
+        f"⚙️ Фоновых задач: {len(current_profile().jobs)} (ошибок: {METRICS['message_jobs_failed']}, "
+        f"отклонено: {METRICS['message_jobs_rejected']})\n"
+        "📡 Статус: Активен"
+    )
+
+@callback_route('adm', 'settings', admin_only=True)
+async def admin_settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Текущие настройки бота."""
+    await update.callback_query.edit_message_text(
+        build_admin_settings_text(), reply_markup=ADMIN_SETTINGS_KEYBOARD, parse_mode=ParseMode.HTML
+    )
+
+@callback_route('adm', 'model', admin_only=True)
+async def admin_change_model_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Переключение модели на следующую из MODEL_OPTIONS."""
+    profile = current_profile()
+    index = MODEL_OPTIONS.index(profile.model) if profile.model in MODEL_OPTIONS else -1
+    profile.model = MODEL_OPTIONS[(index + 1) % len(MODEL_OPTIONS)]
+    logger.info(f"🤖 [{profile.name}] Модель изменена на {profile.model}")
+    await update.callback_query.edit_message_text(
+        build_admin_settings_text(), reply_markup=ADMIN_SETTINGS_KEYBOARD, parse_mode=ParseMode.HTML
+    )
+
+@callback_route('adm', 'formatting', admin_only=True)
+async def admin_change_formatting_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Переключение режима форматирования между "strip" и "parse"."""
+    profile = current_profile()
+    profile.formatting_mode = "parse" if profile.formatting_mode == "strip" else "strip"
+    logger.info(f"📝 [{profile.name}] Режим форматирования изменен на {profile.formatting_mode}")
+    await update.callback_query.edit_message_text(
+        build_admin_settings_text(), reply_markup=ADMIN_SETTINGS_KEYBOARD, parse_mode=ParseMode.HTML
+    )
+
+
+class TokenBucket:
+    """Ограничитель скорости: не более rate операций в секунду с запасом capacity."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Останавливает выдачу токенов всем ожидающим на seconds секунд (например, после RetryAfter)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        # После паузы запас начинает накапливаться заново
+        self.tokens = 0
+        self.updated = self.paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def create_broadcast(text):
+    """Создает черновик рассылки и возвращает его id и число получателей."""
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COUNT(*) FROM users
+            WHERE user_id NOT IN (SELECT user_id FROM inactive_users)
+        ''')
+        total = cursor.fetchone()[0]
+        cursor.execute("INSERT INTO broadcasts (text, total) VALUES (?, ?)", (text, total))
+        conn.commit()
+        return cursor.lastrowid, total
     
     finally:
         if 'conn' in locals():
             conn.close()
 
-    # Остальная логика функции (без query.answer())
-    # ...
-async def handle_admin_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """
-    Обработчик кнопок административной панели.
-    """
-    query = update.callback_query
-    await query.answer()
+def get_broadcast(broadcast_id):
+    """Состояние рассылки или None."""
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
     
-    user_id = update.effective_user.id
-    if user_id != ADMIN_ID:
-        await query.edit_message_text("❌ У вас нет доступа к административной панели.")
-        return
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+def update_broadcast(broadcast_id, **fields):
+    """Сохраняет изменения (контрольную точку) рассылки."""
+    assignments = ', '.join(f"{name} = ?" for name in fields)
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        conn.execute(f"UPDATE broadcasts SET {assignments} WHERE id = ?", (*fields.values(), broadcast_id))
+        conn.commit()
     
-    data = query.data
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+def fetch_broadcast_recipients(after_user_id, limit):
+    """Следующая пачка активных получателей по возрастанию user_id (постраничный обход по индексу)."""
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_id FROM users
+            WHERE user_id > ? AND user_id NOT IN (SELECT user_id FROM inactive_users)
+            ORDER BY user_id
+            LIMIT ?
+        ''', (after_user_id, limit))
+        return [row[0] for row in cursor.fetchall()]
     
-    if data == 'admin_stats':
-        # Показываем подробную статистику
-        try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            
-            # Статистика по дням
-            cursor.execute('''
-                SELECT 
-                    date(timestamp) as interaction_date, 
-                    COUNT(*) as daily_interactions 
-                FROM interactions 
-                GROUP BY interaction_date 
-                ORDER BY interaction_date DESC 
-                LIMIT 7
-            ''')
-            daily_stats = cursor.fetchall()
-            
-            stats_text = "📊 Детальная статистика взаимодействий за 7 дней:\n\n"
-            for date, count in daily_stats:
-                stats_text += f"📅 {date}: {count} взаимодействий\n"
-            
-            await query.edit_message_text(stats_text)
-        
-        except sqlite3.Error as e:
-            logger.error(f"Ошибка получения статистики: {e}")
-            await query.edit_message_text("❌ Не удалось получить детальную статистику.")
-        
-        finally:
-            if 'conn' in locals():
-                conn.close()
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+def mark_user_inactive(user_id, reason):
+    """Исключает пользователя из последующих рассылок."""
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        conn.execute(
+            "INSERT OR REPLACE INTO inactive_users (user_id, reason) VALUES (?, ?)",
+            (user_id, reason)
+        )
+        conn.commit()
     
-    elif data == 'admin_users':
-        # Показываем список последних активных пользователей
-        try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT DISTINCT user_id, username, MAX(timestamp) as last_interaction 
-                FROM interactions 
-                GROUP BY user_id, username 
-                ORDER BY last_interaction DESC 
-                LIMIT 10
-            ''')
-            recent_users = cursor.fetchall()
-            
-            users_text = "👥 Последние активные пользователи:\n\n"
-            for user_id, username, last_interaction in recent_users:
-                users_text += f"👤 {username or 'Без имени'} (ID: {user_id})\n"
-                users_text += f"🕒 Последнее взаимодействие: {last_interaction}\n\n"
-            
-            await query.edit_message_text(users_text)
-        
-        except sqlite3.Error as e:
-            logger.error(f"Ошибка получения списка пользователей: {e}")
-            await query.edit_message_text("❌ Не удалось получить список пользователей.")
-        
-        finally:
-            if 'conn' in locals():
-                conn.close()
+    except sqlite3.Error as e:
+        logger.error(f"❌ Не удалось отметить пользователя {user_id} неактивным: {e}")
     
-    elif data == 'admin_logs':
-        # Показываем последние системные логи
-        log_content = ""
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+async def send_broadcast_message(bot, bucket, user_id, text):
+    """Отправка одного сообщения рассылки. Возвращает "sent", "blocked" или "failed"."""
+    for _ in range(3):
+        await bucket.acquire()
+        try:
+            await bot.send_message(user_id, text)
+            return "sent"
+        except RetryAfter as e:
+            # Telegram просит подождать - приостанавливаем всех отправителей и повторяем этому же пользователю
+            retry_after = e.retry_after
+            if hasattr(retry_after, 'total_seconds'):
+                retry_after = retry_after.total_seconds()
+            logger.warning(f"⏳ Рассылка: RetryAfter {retry_after} с")
+            bucket.pause(retry_after)
+        except Forbidden as e:
+            # Бот заблокирован или пользователь удален
+            mark_user_inactive(user_id, str(e)[:200])
+            return "blocked"
+        except BadRequest as e:
+            if any(error in str(e).lower() for error in BROADCAST_INACTIVE_ERRORS):
+                mark_user_inactive(user_id, str(e)[:200])
+                return "blocked"
+            logger.error(f"Ошибка отправки рассылки пользователю {user_id}: {str(e)}")
+            return "failed"
+        except Exception as e:
+            logger.error(f"Ошибка отправки рассылки пользователю {user_id}: {str(e)}")
+            return "failed"
+    return "failed"
+
+def format_broadcast_status(broadcast, elapsed, processed_before=0):
+    """
+    Текст сообщения о ходе рассылки со скоростью и оценкой оставшегося времени.
+    processed_before - сколько получателей было обработано до текущего запуска (не входит в скорость).
+    """
+    processed = broadcast["sent"] + broadcast["failed"] + broadcast["blocked"]
+    speed = (processed - processed_before) / elapsed if elapsed > 0 else 0
+    remaining = max(broadcast["total"] - processed, 0)
+    eta = f"{int(remaining / speed // 60)} мин {int(remaining / speed % 60)} с" if speed > 0 else "—"
+    status_names = {
+        "running": "⏳ Идет рассылка",
+        "done": "✅ Рассылка завершена",
+        "cancelled": "⛔ Рассылка остановлена"
+    }
+    return (
+        f"{status_names.get(broadcast['status'], broadcast['status'])} #{broadcast['id']}\n\n"
+        f"📨 Отправлено: {broadcast['sent']} из ~{broadcast['total']}\n"
+        f"🚫 Заблокировали бота: {broadcast['blocked']}\n"
+        f"❌ Ошибок: {broadcast['failed']}\n"
+        f"⚡ Скорость: {speed:.1f} сообщ./с\n"
+        f"🕒 Осталось: {eta if broadcast['status'] == 'running' else '—'}"
+    )
+
+def make_stop_keyboard(broadcast_id):
+    """Кнопка остановки идущей рассылки под сообщением о ее статусе."""
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("⛔ Остановить", callback_data=make_callback_data('bc', 'cancel', broadcast_id))
+    ]])
+
+async def run_broadcast(bot, broadcast_id):
+    """
+    Рассылка пачками: получатели читаются из БД, отправка ограничена TokenBucket,
+    после каждой пачки прогресс сохраняется, поэтому рассылка переживает перезапуск.
+    """
+    bucket = TokenBucket(BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    broadcast = get_broadcast(broadcast_id)
+    started = time.monotonic()
+    processed_at_start = broadcast["sent"] + broadcast["failed"] + broadcast["blocked"]
+    last_status_update = 0
+    stop_keyboard = make_stop_keyboard(broadcast_id)
+
+    async def send(user_id):
+        async with semaphore:
+            return await send_broadcast_message(bot, bucket, user_id, broadcast["text"])
+
+    async def show_status():
+        if not broadcast["status_message_id"]:
+            return
         try:
-            with open('bot.log', 'r') as log_file:
-                # Читаем последние 20 строк
-                log_content = ''.join(log_file.readlines()[-20:])
+            # Сообщение, отредактированное без reply_markup, теряет клавиатуру:
+            # кнопка остановки передается, пока рассылка идет, и убирается в итоговом статусе
+            await bot.edit_message_text(
+                format_broadcast_status(broadcast, time.monotonic() - started, processed_at_start),
+                chat_id=broadcast["status_chat_id"],
+                message_id=broadcast["status_message_id"],
+                reply_markup=stop_keyboard if broadcast["status"] == "running" else None
+            )
         except Exception as e:
-            log_content = f"Ошибка чтения логов: {str(e)}"
-        
-        await query.edit_message_text(f"🔍 Последние системные логи:\n\n{log_content}")
-    
-    elif data == 'admin_settings':
-        # Показываем текущие настройки бота
-        settings_text = (
-            "🛠 <b>Настройки бота</b>:\n\n"
-            f"🤖 Модель: {MODEL}\n"
-            f"📝 Режим форматирования: {FORMATTING_MODE}\n"
-            f"📊 Максимальное количество API-запросов: {API_SEMAPHORE._value}\n"
-            "📡 Статус: Активен"
+            logger.warning(f"Не удалось обновить статус рассылки: {str(e)}")
+
+    try:
+        while True:
+            # Рассылку могли остановить кнопкой
+            if get_broadcast(broadcast_id)["status"] != "running":
+                broadcast["status"] = "cancelled"
+                break
+
+            recipients = fetch_broadcast_recipients(broadcast["last_user_id"], BROADCAST_BATCH_SIZE)
+            if not recipients:
+                broadcast["status"] = "done"
+                break
+
+            results = await asyncio.gather(*(send(user_id) for user_id in recipients))
+            broadcast["sent"] += results.count("sent")
+            broadcast["blocked"] += results.count("blocked")
+            broadcast["failed"] += results.count("failed")
+            broadcast["last_user_id"] = recipients[-1]
+            update_broadcast(
+                broadcast_id,
+                last_user_id=broadcast["last_user_id"],
+                sent=broadcast["sent"],
+                blocked=broadcast["blocked"],
+                failed=broadcast["failed"]
+            )
+            METRICS['broadcast_sent'] += results.count("sent")
+
+            if time.monotonic() - last_status_update >= BROADCAST_STATUS_INTERVAL:
+                last_status_update = time.monotonic()
+                await show_status()
+
+        if broadcast["status"] == "done":
+            update_broadcast(broadcast_id, status="done", finished_at=time.strftime('%Y-%m-%d %H:%M:%S'))
+        await show_status()
+        logger.info(f"📣 Рассылка #{broadcast_id}: {broadcast['status']}, отправлено {broadcast['sent']}")
+
+    except Exception as e:
+        logger.error(f"❌ Ошибка рассылки #{broadcast_id}: {e}")
+
+    finally:
+        current_profile().broadcast_tasks.pop(broadcast_id, None)
+
+def start_broadcast_task(bot, broadcast_id):
+    """Запускает рассылку в фоне, если она еще не запущена."""
+    broadcast_tasks = current_profile().broadcast_tasks
+    if broadcast_id not in broadcast_tasks:
+        broadcast_tasks[broadcast_id] = asyncio.create_task(run_broadcast(bot, broadcast_id))
+
+async def resume_broadcasts(application):
+    """Продолжение рассылок, прерванных перезапуском бота."""
+    try:
+        conn = sqlite3.connect(current_profile().db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM broadcasts WHERE status = 'running'")
+        broadcast_ids = [row[0] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка чтения рассылок: {e}")
+        return
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+    for broadcast_id in broadcast_ids:
+        logger.info(f"▶️ Продолжение рассылки #{broadcast_id}")
+        start_broadcast_task(application.bot, broadcast_id)
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Рассылка объявления всем пользователям (/broadcast <текст>).
+    Сначала показывается предпросмотр с кнопкой подтверждения.
+    """
+    if update.effective_user.id != current_profile().admin_id:
+        await update.message.reply_text("❌ У вас нет доступа к этой команде.")
+        return
+
+    # Текст берем целиком, сохраняя переносы строк
+    text = update.message.text.partition(' ')[2].strip()
+    if not text:
+        await update.message.reply_text("Использование: /broadcast <текст объявления>")
+        return
+    if utf16_len(text) > TELEGRAM_MESSAGE_LIMIT:
+        await update.message.reply_text(
+            f"❌ Текст слишком длинный: {utf16_len(text)} символов при лимите Telegram {TELEGRAM_MESSAGE_LIMIT}. "
+            "Сократите объявление или разделите его на несколько рассылок."
         )
-        
-        # Клавиатура для настроек
-        keyboard = [
-            [
-                InlineKeyboardButton("🔄 Сменить модель", callback_data='change_model'),
-                InlineKeyboardButton("📝 Режим форматирования", callback_data='change_formatting')
-            ],
-            [
-                InlineKeyboardButton("🔙 Назад", callback_data='back_to_admin_panel')
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(settings_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-    # Добавьте обработку других кнопок
-    async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-     await update.message.reply_text("✅ Сообщение обработано!")
-     
+        return
 
+    try:
+        broadcast_id, total = create_broadcast(text)
+    except sqlite3.Error as e:
+        logger.error(f"❌ Ошибка создания рассылки: {e}")
+        await update.message.reply_text("❌ Не удалось создать рассылку.")
+        return
 
-def main():
-    """Основная функция для запуска бота."""
-    # Дополнительное логирование
-    logging.basicConfig(
-        level=logging.DEBUG,  # Более подробное логирование
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton("📣 Отправить", callback_data=make_callback_data('bc', 'start', broadcast_id)),
+        InlineKeyboardButton("✖️ Отмена", callback_data=make_callback_data('bc', 'cancel', broadcast_id))
+    ]])
+    preview = f"📣 Рассылка #{broadcast_id} для ~{total} пользователей:\n\n{text}"
+    if utf16_len(preview) > TELEGRAM_MESSAGE_LIMIT:
+        # Заголовок не помещается вместе с текстом - отправляем его отдельно
+        await update.message.reply_text(f"📣 Рассылка #{broadcast_id} для ~{total} пользователей:")
+        preview = text
+    await update.message.reply_text(preview, reply_markup=keyboard)
+
+@callback_route('bc', 'start', admin_only=True)
+async def broadcast_start_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Подтверждение рассылки."""
+    query = update.callback_query
+    broadcast = get_broadcast(int(arg)) if arg and arg.isdigit() else None
+    if not broadcast or broadcast["status"] != "draft":
+        await query.edit_message_text("❌ Рассылка не найдена или уже запущена.")
+        return
+
+    await query.edit_message_text(
+        f"⏳ Рассылка #{broadcast['id']} запускается...", reply_markup=make_stop_keyboard(broadcast["id"])
     )
-    logger = logging.getLogger(__name__)
+    update_broadcast(
+        broadcast["id"],
+        status="running",
+        status_chat_id=query.message.chat_id,
+        status_message_id=query.message.message_id
+    )
+    start_broadcast_task(context.bot, broadcast["id"])
 
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+@callback_route('bc', 'cancel', admin_only=True)
+async def broadcast_cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, arg):
+    """Отмена черновика или остановка идущей рассылки."""
+    query = update.callback_query
+    broadcast = get_broadcast(int(arg)) if arg and arg.isdigit() else None
+    if not broadcast or broadcast["status"] not in ("draft", "running"):
+        await query.edit_message_text("❌ Рассылка не найдена или уже завершена.")
+        return
+
+    update_broadcast(broadcast["id"], status="cancelled", finished_at=time.strftime('%Y-%m-%d %H:%M:%S'))
+    if broadcast["status"] == "draft":
+        await query.edit_message_text(f"✖️ Рассылка #{broadcast['id']} отменена.")
+    # Идущая рассылка остановится после текущей пачки и сама обновит сообщение о статусе
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+    Обновления разных пользователей обрабатываются одновременно (до max_concurrent_updates),
+    обновления одного пользователя - строго по очереди. При превышении max_pending_updates
+    новые обновления отклоняются.
+
+    Семафор BaseUpdateProcessor (process_update, помечен в PTB как @final) ограничивает число
+    принятых обновлений: max_pending_updates плюс один слот, через который при перегрузке
+    проходят отклоняемые обновления. Число одновременно обрабатываемых обновлений ограничивает
+    собственный семафор, который берется уже после блокировки пользователя.
+    """
+
+    def __init__(self, max_concurrent_updates, max_pending_updates):
+        super().__init__(max_pending_updates + 1)
+        self.max_pending_updates = max_pending_updates
+        self.pending_updates = 0
+        self._processing_semaphore = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # (id бота, user_id) -> [блокировка, количество обновлений пользователя в очереди]
+        self._user_locks = {}
+        # (id бота, user_id) -> время последнего уведомления о перегрузке
+        self._overload_notices = {}
+
+    async def do_process_update(self, update, coroutine):
+        if self.pending_updates >= self.max_pending_updates:
+            coroutine.close()
+            METRICS['updates_rejected'] += 1
+            await self._reject_update(update)
+            return
+
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            self.pending_updates += 1
+            try:
+                async with self._processing_semaphore:
+                    await coroutine
+            finally:
+                self.pending_updates -= 1
+            return
+
+        # Очереди пользователей раздельны для каждого бота: обработчик обновлений общий для всех ботов процесса
+        lock_key = (update.get_bot().id, user.id)
+        entry = self._user_locks.setdefault(lock_key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        self.pending_updates += 1
+        try:
+            # Блокировку пользователя берем до семафора, чтобы очередь одного пользователя
+            # не занимала общие слоты; asyncio.Lock пропускает ожидающих в порядке прихода
+            async with entry[0]:
+                async with self._processing_semaphore:
+                    await coroutine
+        finally:
+            self.pending_updates -= 1
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._user_locks.pop(lock_key, None)
+
+    async def _reject_update(self, update):
+        """
+        Сообщает пользователю, что бот перегружен, - не чаще раза в OVERLOAD_NOTICE_INTERVAL,
+        чтобы при перегрузке не добавлять исходящих запросов к API.
+        """
+        logger.warning("⚠️ Слишком много обновлений в очереди, обновление отклонено")
+        if not isinstance(update, Update) or update.effective_user is None:
+            return
+
+        now = time.monotonic()
+        notice_key = (update.get_bot().id, update.effective_user.id)
+        if now - self._overload_notices.get(notice_key, float('-inf')) < OVERLOAD_NOTICE_INTERVAL:
+            return
+        if len(self._overload_notices) > MAX_PENDING_UPDATES:
+            # Устаревшие отметки больше не влияют на уведомления
+            self._overload_notices = {
+                key: noticed for key, noticed in self._overload_notices.items()
+                if now - noticed < OVERLOAD_NOTICE_INTERVAL
+            }
+        self._overload_notices[notice_key] = now
+
+        try:
+            if update.callback_query:
+                await update.callback_query.answer("⏳ Бот перегружен, попробуйте через минуту.")
+            elif update.effective_message:
+                await update.effective_message.reply_text("⏳ Бот сейчас перегружен. Пожалуйста, попробуйте через минуту.")
+        except Exception as e:
+            logger.error(f"Не удалось уведомить пользователя о перегрузке: {str(e)}")
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def build_application(profile, update_processor):
+    """Создает Application бота с обработчиками команд, сообщений, кнопок и обслуживанием БД."""
+    application = (
+        Application.builder()
+        .token(profile.token)
+        .concurrent_updates(update_processor)
+        .post_init(resume_message_jobs)
+        .post_stop(drain_message_jobs)
+        .build()
+    )
 
     # Команды
     application.add_handler(CommandHandler("start", start))
@@ -950,8 +2847,12 @@ def main():
     application.add_handler(CommandHandler("setadmin", command_setadmin))
     application.add_handler(CommandHandler("feedback", feedback_command))
     application.add_handler(CommandHandler("history", history_command))
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(CommandHandler("progress", progress_command))
     application.add_handler(CommandHandler("admin", admin_panel_command))
-    application.add_handler(CallbackQueryHandler(button_callback, pattern='^(new_task|task_completed)$'))
+    application.add_handler(CommandHandler("maintenance", maintenance_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("broadcast", broadcast_command))
 
     # Обработчик для всех текстовых сообщений с подробным логированием
     async def debug_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -968,9 +2869,131 @@ def main():
     # Регистрация обработчика сообщений
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, debug_message_handler))
 
-    # Обработчики кнопок
-    application.add_handler(CallbackQueryHandler(handle_button))
-    application.add_handler(CallbackQueryHandler(handle_admin_buttons, pattern="^admin_"))
+    # Все нажатия кнопок обрабатываются через таблицу маршрутов CALLBACK_ROUTES
+    application.add_handler(CallbackQueryHandler(dispatch_callback))
+
+    # Периодическое обслуживание БД (требуется python-telegram-bot[job-queue])
+    if application.job_queue:
+        application.job_queue.run_repeating(database_maintenance_job, interval=MAINTENANCE_INTERVAL, first=60)
+    else:
+        logger.warning("⚠️ JobQueue недоступна, обслуживание БД выполняется только командой /maintenance")
+
+    return application
+
+def load_bot_profiles(config_path):
+    """
+    Читает настройки ботов из JSON-файла вида:
+    {"bots": [{"name": "main", "token": "...", "admin_id": 123, "model": "deepseek/deepseek-r1",
+               "formatting_mode": "strip", "system_prompt_path": "prompts/main.txt", "tasks_path": "tasks.txt", "db_path": "main.db"}]}
+    Обязательны name и token. Относительные пути считаются от каталога файла настроек.
+    Не указанные параметры берутся из настроек этого файла, а БД, архив и журнал задач
+    по умолчанию получают имя бота, чтобы данные ботов не смешивались.
+    """
+    base_dir = os.path.dirname(os.path.abspath(config_path))
+    with open(config_path, 'r', encoding='utf-8') as config_file:
+        config = json.load(config_file)
+
+    profiles = []
+    for bot in config.get("bots", []):
+        name = bot.get("name")
+        if not name or not bot.get("token"):
+            raise ValueError("у каждого бота должны быть указаны name и token")
+
+        system_prompt = bot.get("system_prompt", SYSTEM_PROMPT)
+        if bot.get("system_prompt_path"):
+            with open(os.path.join(base_dir, bot["system_prompt_path"]), 'r', encoding='utf-8') as prompt_file:
+                system_prompt = prompt_file.read()
+
+        profiles.append(BotProfile(
+            name,
+            bot["token"],
+            admin_id=bot.get("admin_id"),
+            model=bot.get("model", MODEL),
+            formatting_mode=bot.get("formatting_mode", FORMATTING_MODE),
+            system_prompt=system_prompt,
+            tasks_path=os.path.join(base_dir, bot["tasks_path"]) if bot.get("tasks_path") else TASKS_PATH,
+            db_path=os.path.join(base_dir, bot.get("db_path", f"bot_interactions_{name}.db")),
+            archive_dir=os.path.join(base_dir, bot.get("archive_dir", os.path.join("archive", name))),
+            jobs_journal_path=os.path.join(base_dir, f"pending_jobs_{name}.json")
+        ))
+
+    if not profiles:
+        raise ValueError("не указано ни одного бота")
+    for field in ("name", "token", "db_path"):
+        values = [getattr(profile, field) for profile in profiles]
+        if len(set(values)) != len(values):
+            raise ValueError(f"значения {field} у ботов должны различаться")
+    return profiles
+
+async def serve_bot(profile, update_processor, stop_event):
+    """Запускает одного бота в многоботовом режиме и останавливает его по stop_event."""
+    # Значение наследуют все задачи бота: получение обновлений, обработчики, JobQueue и фоновые задачи
+    ACTIVE_PROFILE.set(profile)
+    # Схема БД создается и обновляется один раз при запуске бота
+    ensure_database()
+    application = build_application(profile, update_processor)
+
+    try:
+        # Тот же порядок, что и в run_polling, включая post_init и post_stop
+        await application.initialize()
+        await application.post_init(application)
+        await application.updater.start_polling(drop_pending_updates=True)
+        await application.start()
+        logger.info(f"✅ [{profile.name}] Бот запущен")
+        await stop_event.wait()
+    except Exception as e:
+        logger.error(f"❌ [{profile.name}] Ошибка запуска бота: {e}")
+    finally:
+        try:
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+                await application.post_stop(application)
+            await application.shutdown()
+        except Exception as e:
+            logger.error(f"❌ [{profile.name}] Ошибка остановки бота: {e}")
+
+async def run_bots(profiles):
+    """Многоботовый режим: все боты работают в одном процессе и одном цикле событий."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # На Windows остановка по Ctrl+C приходит как KeyboardInterrupt
+            pass
+
+    # Обработчик обновлений общий: лимиты параллельной обработки действуют на весь процесс
+    update_processor = UserOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES)
+    await asyncio.gather(*(serve_bot(profile, update_processor, stop_event) for profile in profiles))
+
+def main():
+    """Основная функция для запуска бота."""
+    # Дополнительное логирование
+    logging.basicConfig(
+        level=logging.DEBUG,  # Более подробное логирование
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    logger = logging.getLogger(__name__)
+
+    # Несколько ботов в одном процессе
+    if os.path.exists(BOTS_CONFIG_PATH):
+        try:
+            profiles = load_bot_profiles(BOTS_CONFIG_PATH)
+        except (OSError, ValueError) as e:
+            logger.error(f"❌ Ошибка в настройках ботов {BOTS_CONFIG_PATH}: {e}")
+            return
+        logger.info(f"✅ Запускаются боты: {', '.join(profile.name for profile in profiles)}")
+        asyncio.run(run_bots(profiles))
+        return
+
+    # Схема БД создается и обновляется один раз при запуске бота
+    ensure_database()
+    application = build_application(
+        DEFAULT_PROFILE, UserOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES, MAX_PENDING_UPDATES)
+    )
 
     logger.info("✅ Бот запускается...")
     
@@ -0,0 +1,85 @@
+"""Fuzz-тесты разбиения ответов на части (split_message / build_response_parts)."""
+import random
+
+import pytest
+
+import botpa
+
+# Алфавит с кириллицей, специальными символами Markdown V2, переносами строк
+# и символами вне BMP (занимают две единицы UTF-16)
+ALPHABET = (
+    list("абвгдеёжзийклмнопрстуфхцчшщъыьэюяabcxyz0123456789")
+    + list(botpa.MARKDOWN_V2_SPECIAL)
+    + [" ", " ", " ", "\n", "\n\n", ". ", "! ", "? ", "…", "\t"]
+    + ["😀", "👍🏽", "🧘", "𝔘"]
+)
+
+
+def random_text(rng, length):
+    return "".join(rng.choice(ALPHABET) for _ in range(length))
+
+
+def has_unescaped_specials(text):
+    """Есть ли специальный символ без экранирования или обратная косая черта без символа после нее."""
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == "\\":
+            if i + 1 >= len(text) or not 1 <= ord(text[i + 1]) <= 126:
+                return True
+            i += 2
+            continue
+        if char in botpa.MARKDOWN_V2_SPECIAL:
+            return True
+        i += 1
+    return False
+
+
+def fuzz_cases(seed, count):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield random_text(rng, rng.choice([10, 500, 4000, 4096, 5000, 12000, 30000]))
+
+
+@pytest.mark.parametrize("formatting_mode", ["strip", "parse"])
+def test_parts_fit_telegram_limit(formatting_mode):
+    for text in fuzz_cases(seed=formatting_mode, count=150):
+        for part in botpa.build_response_parts(text, formatting_mode):
+            assert 0 < botpa.utf16_len(part) <= botpa.TELEGRAM_MESSAGE_LIMIT
+
+
+def test_parse_mode_parts_are_escaped():
+    for text in fuzz_cases(seed=34, count=150):
+        for part in botpa.build_response_parts(text, "parse"):
+            assert not has_unescaped_specials(part)
+
+
+def test_parts_have_headers_only_when_split():
+    rng = random.Random(7)
+    for text in fuzz_cases(seed=7, count=100):
+        parts = botpa.build_response_parts(text, rng.choice(["strip", "parse"]))
+        if len(parts) == 1:
+            assert not parts[0].startswith("Часть ")
+        else:
+            for i, part in enumerate(parts, start=1):
+                assert part.startswith(f"Часть {i}/{len(parts)}:")
+
+
+def test_split_keeps_all_non_space_characters():
+    for text in fuzz_cases(seed=99, count=100):
+        chunks = botpa.split_message(text, limit=1000)
+        assert "".join("".join(chunks).split()) == "".join(text.split())
+
+
+def test_surrogate_pairs_are_not_cut():
+    text = "😀" * 5000
+    chunks = botpa.split_message(text)
+    assert all(botpa.utf16_len(chunk) <= botpa.TELEGRAM_MESSAGE_LIMIT for chunk in chunks)
+    assert "".join(chunks) == text
+
+
+def test_split_prefers_paragraph_boundaries():
+    paragraph = "слово " * 300
+    text = "\n\n".join(paragraph.strip() for _ in range(5))
+    for chunk in botpa.split_message(text, limit=4000):
+        assert chunk.startswith("слово") and chunk.endswith("слово")